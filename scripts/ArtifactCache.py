@@ -0,0 +1,138 @@
+# SYSTEM IMPORTS
+import json
+import os
+import shutil
+import threading
+import time
+
+# PYTHON PROJECT IMPORTS
+import Utilities
+
+
+def makeKey(packageName, config, OS, buildNum):
+    return "%s/%s/%s/%s" % (packageName, config, OS, buildNum)
+
+
+# a persistent cache of downloaded package archives that lives outside of the build tree.
+# Archives are stored by the sha256 of their contents (so identical archives are only stored
+# once) and are looked up by a key made from the package name, config, OS and build number.
+# The cache is bounded in size: when it grows too big, the least recently used archives are
+# removed. Every archive is checked against its digest before it is handed out.
+#
+# layout:
+#   <cacheDir>/index.json                   key -> {digest, fileName, size, lastUsed}
+#   <cacheDir>/objects/<digest[:2]>/<digest>
+class ArtifactCache(object):
+    def __init__(self, cacheDir, maxSizeBytes):
+        self._cacheDir = cacheDir
+        self._maxSizeBytes = maxSizeBytes
+        self._lock = threading.Lock()
+        Utilities.mkdir(os.path.join(self._cacheDir, "objects"))
+
+    def getIndexPath(self):
+        return os.path.join(self._cacheDir, "index.json")
+
+    def getObjectPath(self, digest):
+        return os.path.join(self._cacheDir, "objects", digest[:2], digest)
+
+    def loadIndex(self):
+        if not os.path.exists(self.getIndexPath()):
+            return {}
+        try:
+            with open(self.getIndexPath(), "r") as f:
+                return json.load(f)
+        except ValueError:
+            # a corrupt index only costs us the cached archives
+            print("Artifact cache index %s is corrupt. Starting with an empty cache" % self.getIndexPath())
+            return {}
+
+    def saveIndex(self, index):
+        with Utilities.atomicWrite(self.getIndexPath()) as tmpIndexPath, open(tmpIndexPath, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+
+    def removeEntry(self, index, key):
+        digest = index.pop(key)["digest"]
+        if len([entry for entry in index.values() if entry["digest"] == digest]) == 0 and\
+           os.path.exists(self.getObjectPath(digest)):
+            os.remove(self.getObjectPath(digest))
+
+    # returns the digest of the archive stored under key or None
+    def getDigest(self, key):
+        with self._lock:
+            entry = self.loadIndex().get(key)
+            return entry["digest"] if entry is not None else None
+
+    # copies the archive stored under key to destPath. Returns False if the archive is not
+    # in the cache or if it failed the integrity check (in which case it is removed).
+    def get(self, key, destPath):
+        with self._lock:
+            entry = self.loadIndex().get(key)
+        if entry is None:
+            return False
+
+        # the archive is checked outside of the lock so that archives can be checked in parallel
+        objectPath = self.getObjectPath(entry["digest"])
+        if not os.path.exists(objectPath) or os.path.getsize(objectPath) != entry["size"] or\
+           Utilities.hashFile(objectPath, "sha256") != entry["digest"]:
+            print("Cached archive for [%s] failed its integrity check. Removing it" % key)
+            with self._lock:
+                index = self.loadIndex()
+                if key in index and index[key]["digest"] == entry["digest"]:
+                    self.removeEntry(index, key)
+                    self.saveIndex(index)
+            return False
+
+        if os.path.exists(destPath):
+            Utilities.rmTree(destPath)
+        try:
+            os.link(objectPath, destPath)
+        except (AttributeError, OSError):
+            try:
+                shutil.copy2(objectPath, destPath)
+            except (IOError, OSError):
+                # the archive was evicted in the meantime
+                return False
+
+        with self._lock:
+            index = self.loadIndex()
+            if key in index:
+                index[key]["lastUsed"] = time.time()
+                self.saveIndex(index)
+        return True
+
+    # stores the archive at srcPath under key. Returns the digest of the archive.
+    def put(self, key, srcPath):
+        digest = Utilities.hashFile(srcPath, "sha256")
+        with self._lock:
+            objectPath = self.getObjectPath(digest)
+            if not os.path.exists(objectPath):
+                Utilities.mkdir(os.path.dirname(objectPath))
+                with Utilities.atomicWrite(objectPath) as tmpObjectPath:
+                    shutil.copy2(srcPath, tmpObjectPath)
+            index = self.loadIndex()
+            if key in index and index[key]["digest"] != digest:
+                self.removeEntry(index, key)
+            index[key] = {
+                "digest": digest,
+                "fileName": os.path.basename(srcPath),
+                "size": os.path.getsize(objectPath),
+                "lastUsed": time.time(),
+            }
+            self.evict(index)
+            self.saveIndex(index)
+        return digest
+
+    # removes the least recently used archives until the cache fits in maxSizeBytes
+    def evict(self, index):
+        objectSizes = {}
+        for entry in index.values():
+            objectSizes[entry["digest"]] = entry["size"]
+        totalSize = sum(objectSizes.values())
+        for key in sorted(index.keys(), key=lambda key: index[key]["lastUsed"]):
+            if totalSize <= self._maxSizeBytes:
+                break
+            digest = index[key]["digest"]
+            print("Evicting [%s] from the artifact cache" % key)
+            self.removeEntry(index, key)
+            if len([entry for entry in index.values() if entry["digest"] == digest]) == 0:
+                totalSize -= objectSizes[digest]
@@ -0,0 +1,103 @@
+# SYSTEM IMPORTS
+import os
+import shutil
+import tempfile
+import threading
+
+# PYTHON PROJECT IMPORTS
+import Utilities
+
+
+DB_NAME = "buildcache"
+
+
+# a build output cache that is shared through the package server (or any request object with
+# the same interface, like PackageStoreRequest). The output directory of a package is stored
+# under a key that identifies everything that went into building it (see
+# MetaBuild.getBuildCacheKey), so any machine that builds the same inputs can download the
+# output instead of compiling it.
+#
+# on the server:
+#   records     dbName "buildcache", collection <package name>: {cache_key, fileName, filetype, relativeUrl}
+#   files       buildcache/<package name>/<cache key>.tar.gz
+class BuildCache(object):
+    def __init__(self, httpRequest, readOnly=False):
+        self._httpRequest = httpRequest
+        self._readOnly = readOnly
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+
+    def isReadOnly(self):
+        return self._readOnly
+
+    # counts a package that could not be looked up (its cache key is not known)
+    def addMiss(self):
+        with self._lock:
+            self._misses += 1
+
+    # replaces outRoot with the cached output of a package. Returns False if there is none.
+    def fetch(self, packageName, cacheKey, outRoot):
+        # other machines add outputs all the time: don't trust a cached answer
+        records = self._httpRequest.query(DB_NAME, packageName, dbParams={"cache_key": cacheKey}, cached=False)
+        if len(records) == 0:
+            with self._lock:
+                self._misses += 1
+            return False
+
+        downloadDir = tempfile.mkdtemp(prefix="rbuild_cache_")
+        try:
+            self._httpRequest.downloadRecord(downloadDir, records[-1])
+            if os.path.exists(outRoot):
+                Utilities.rmTree(outRoot)
+            Utilities.mkdir(outRoot)
+            with Utilities.openArchive(os.path.join(downloadDir, records[-1]["fileName"] +
+                                                    records[-1]["filetype"])) as tarFile:
+                tarFile.extractall(outRoot)
+        except (Exception, SystemExit) as e:
+            # a broken cache entry only costs us the build
+            print("Could not fetch cached build of [%s] (%s). Building it" % (packageName, e))
+            if os.path.exists(outRoot):
+                Utilities.rmTree(outRoot)
+            with self._lock:
+                self._misses += 1
+            return False
+        finally:
+            shutil.rmtree(downloadDir, ignore_errors=True)
+        with self._lock:
+            self._hits += 1
+        return True
+
+    # archives outRoot and returns a function that uploads it (so that the caller can decide
+    # where to run it, see MetaBuild.startUpload).
+    def store(self, packageName, cacheKey, outRoot):
+        uploadDir = tempfile.mkdtemp(prefix="rbuild_cache_")
+        fileName = cacheKey + Utilities.getArchiveExtension("tar.gz")
+        with Utilities.createArchive(os.path.join(uploadDir, fileName)) as tarFile:
+            for outDir in sorted(os.listdir(outRoot)):
+                Utilities.addToArchive(tarFile, os.path.join(outRoot, outDir), outDir)
+        dbParams = {
+            "cache_key": cacheKey,
+            "fileName": cacheKey,
+            "filetype": Utilities.getArchiveExtension("tar.gz"),
+            "relativeUrl": "/".join([DB_NAME, packageName, fileName]),
+        }
+
+        def upload():
+            try:
+                self._httpRequest.upload(uploadDir, DB_NAME, packageName, fileName=fileName,
+                                         dbParams=dbParams, urlParams=[DB_NAME, packageName])
+            finally:
+                shutil.rmtree(uploadDir, ignore_errors=True)
+            with self._lock:
+                self._stores += 1
+        return upload
+
+    def printStatistics(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            if lookups == 0:
+                return
+            print("Build cache: %s hits, %s misses (%s%% hit rate), %s outputs stored" %
+                  (self._hits, self._misses, self._hits * 100 // lookups, self._stores))
@@ -0,0 +1,108 @@
+# SYSTEM IMPORTS
+import json
+import os
+import subprocess
+
+# PYTHON PROJECT IMPORTS
+import Utilities
+
+
+LAUNCHERS = ["ccache", "sccache"]
+
+
+# sccache counts per language since 0.3 and only the total before
+def sumCounts(stat):
+    if isinstance(stat, dict):
+        return sum(stat["counts"].values())
+    return stat
+
+
+# a compiler cache (ccache or sccache) that CMake puts in front of the compiler with
+# CMAKE_<LANG>_COMPILER_LAUNCHER. Every workspace has its own cache directory, limited to
+# maxSizeMB, so that the objects of one workspace never evict those of another. Clean builds
+# (see cleanBuildWorkspace) then only compile the translation units that actually changed.
+#
+# the statistics of the cache are reset when the build starts, so getStatistics() returns
+# the hits and misses of this build.
+class CompilerCache(object):
+    def __init__(self, launcher, cacheDir, maxSizeMB, baseDir):
+        if launcher not in LAUNCHERS:
+            Utilities.failExecution("Unknown compiler launcher [%s]" % launcher)
+        self._launcher = launcher
+        self._launcherPath = Utilities.findExecutable(launcher)
+        if self._launcherPath is None:
+            Utilities.failExecution("%s must be installed to use it as the compiler launcher" % launcher)
+        self._cacheDir = cacheDir
+        self._maxSizeMB = maxSizeMB
+        self._baseDir = baseDir
+
+    def getCMakeArgs(self):
+        launcherPath = self._launcherPath.replace("\\", "/")
+        return [
+            "-DCMAKE_C_COMPILER_LAUNCHER=%s" % launcherPath,
+            "-DCMAKE_CXX_COMPILER_LAUNCHER=%s" % launcherPath,
+        ]
+
+    # the environment that the launcher has to run in (every process that the build starts inherits it)
+    def getEnvironment(self):
+        if self._launcher == "ccache":
+            return {
+                "CCACHE_DIR": self._cacheDir,
+                "CCACHE_MAXSIZE": "%sM" % self._maxSizeMB,
+                # absolute paths below the workspace are hashed as relative paths
+                "CCACHE_BASEDIR": self._baseDir,
+            }
+        return {
+            "SCCACHE_DIR": self._cacheDir,
+            "SCCACHE_CACHE_SIZE": "%sM" % self._maxSizeMB,
+        }
+
+    def runLauncher(self, args):
+        environment = dict(os.environ)
+        environment.update(self.getEnvironment())
+        try:
+            return subprocess.check_output([self._launcherPath] + args, stderr=subprocess.STDOUT,
+                                           env=environment).decode("utf-8", "replace")
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    # resets the statistics. sccache also starts its server here, so the server runs with
+    # the environment of this workspace (a server that is already running keeps its own).
+    def start(self):
+        Utilities.mkdir(self._cacheDir)
+        if self.runLauncher(["--zero-stats"]) is None:
+            print("Could not reset the statistics of %s" % self._launcher)
+
+    # returns [hits, misses] of this build, or None if the launcher does not report them
+    def getStatistics(self):
+        if self._launcher == "ccache":
+            # one "<counter>\t<value>" per line (ccache >= 3.7)
+            output = self.runLauncher(["--print-stats"])
+            if output is None:
+                return None
+            counters = {}
+            for line in output.splitlines():
+                fields = line.split("\t")
+                if len(fields) == 2 and fields[1].strip().isdigit():
+                    counters[fields[0]] = int(fields[1])
+            return [counters.get("direct_cache_hit", 0) + counters.get("preprocessed_cache_hit", 0),
+                    counters.get("cache_miss", 0)]
+
+        output = self.runLauncher(["--show-stats", "--stats-format=json"])
+        if output is None:
+            return None
+        try:
+            stats = json.loads(output)["stats"]
+        except (ValueError, KeyError):
+            return None
+        return [sumCounts(stats["cache_hits"]), sumCounts(stats["cache_misses"])]
+
+    def printStatistics(self):
+        statistics = self.getStatistics()
+        if statistics is None:
+            print("Compiler cache (%s): no statistics available" % self._launcher)
+            return
+        hits, misses = statistics
+        compilations = hits + misses
+        print("Compiler cache (%s): %s hits, %s misses (%s%% hit rate)" %
+              (self._launcher, hits, misses, hits * 100 // compilations if compilations > 0 else 0))
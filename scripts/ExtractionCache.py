@@ -0,0 +1,79 @@
+# SYSTEM IMPORTS
+import os
+import threading
+
+# PYTHON PROJECT IMPORTS
+import Utilities
+
+
+# extracts package archives at most once and shares the extracted trees between every package
+# and configuration that depends on them. Extracted trees are found by the sha256 of the archive,
+# so an archive that is rebuilt (or a newer version that is downloaded) is extracted again while
+# an unchanged one never is. Extracted trees are shared: never write into them.
+#
+# layout:
+#   <rootDir>/<archive name>/<digest>/      the contents of the archive
+#
+# only the newest tree of every archive name is kept: the others are removed when a new
+# version is extracted (unless this process is still using them).
+class ExtractionCache(object):
+    def __init__(self, rootDir):
+        self._rootDir = rootDir
+        self._digests = {}
+        self._extracted = set()
+        self._digestLocks = {}
+        self._lock = threading.Lock()
+
+    # the digest of an archive is only computed again if the archive has changed
+    def getDigest(self, archivePath):
+        archivePath = os.path.abspath(archivePath)
+        archiveStat = os.stat(archivePath)
+        archiveId = (archivePath, archiveStat.st_size, archiveStat.st_mtime)
+        with self._lock:
+            digest = self._digests.get(archiveId)
+        if digest is None:
+            digest = Utilities.hashFile(archivePath, "sha256")
+            with self._lock:
+                self._digests[archiveId] = digest
+        return digest
+
+    def getDigestLock(self, digest):
+        with self._lock:
+            if digest not in self._digestLocks:
+                self._digestLocks[digest] = threading.Lock()
+            return self._digestLocks[digest]
+
+    # returns the directory that the archive at archivePath is extracted in
+    def extract(self, archivePath):
+        digest = self.getDigest(archivePath)
+        archiveDir = os.path.join(self._rootDir, os.path.basename(archivePath))
+        extractedPath = os.path.join(archiveDir, digest)
+        with self._lock:
+            self._extracted.add(extractedPath)
+        with self.getDigestLock(digest):
+            if not os.path.isdir(extractedPath):
+                print("Extracting %s" % os.path.basename(archivePath))
+                # extract next to the final directory and rename it into place, so that a
+                # directory with the final name is always complete.
+                tmpExtractedPath = "%s.%s.tmp" % (extractedPath, os.getpid())
+                if os.path.exists(tmpExtractedPath):
+                    Utilities.rmTree(tmpExtractedPath)
+                Utilities.mkdir(tmpExtractedPath)
+                with Utilities.openArchive(archivePath) as tarFile:
+                    tarFile.extractall(tmpExtractedPath)
+                try:
+                    os.rename(tmpExtractedPath, extractedPath)
+                except OSError:
+                    # another build extracted the same archive in the meantime
+                    if not os.path.isdir(extractedPath):
+                        raise
+                    Utilities.rmTree(tmpExtractedPath)
+            with self._lock:
+                self.removeOldVersions(archiveDir)
+        return extractedPath
+
+    def removeOldVersions(self, archiveDir):
+        for entry in os.listdir(archiveDir):
+            entryPath = os.path.join(archiveDir, entry)
+            if entryPath not in self._extracted and not entry.endswith(".tmp"):
+                Utilities.rmTree(entryPath)
@@ -35,6 +35,17 @@ GLOBAL_DEPENDENCIES = 15
 BUILD_DEPENDENCIES = 16
 PACKAGE = 17
 IDE_ROOT = 18
+# the absolute path to the directory holding the caches that are shared between builds.
+# It is kept outside of the project (so that it survives clean builds) and can be moved
+# with the RBUILD_CACHE_DIR env var.
+CACHE_ROOT = 19
+ARTIFACT_CACHE = 20         # the absolute path to the cache of downloaded packages
+METADATA_CACHE = 21         # the absolute path to the cache of package server query results
+PACKAGE_STORE = 22          # the absolute path to the local package store used by -offline builds
+EXTRACTED_DEPENDENCIES = 23  # the absolute path to the extracted package archives shared by all packages
+COMPILER_CACHE = 24         # the absolute path to the compiler cache (see -compiler_launcher) of the project
+BUILD_DURATIONS = 25        # the absolute path to the file with the build times of the packages of the project
+INSTALL_PREFIX = 26         # the absolute path to the directory that a package is installed into and packaged from
 
 
 # a method to get the absolute path to a directory within the project based
@@ -74,5 +85,23 @@ def getDirectory(directoryEnum, configuration='', projectName=''):
         return os.path.join(getDirectory(WORKING, configuration, projectName), "package")
     elif directoryEnum == IDE_ROOT:
         return os.path.join(getDirectory(OUT_ROOT, configuration, projectName), "IDE")
+    elif directoryEnum == CACHE_ROOT:
+        if os.environ.get("RBUILD_CACHE_DIR") is not None:
+            return os.path.abspath(os.environ["RBUILD_CACHE_DIR"])
+        return os.path.join(os.path.expanduser("~"), ".rbuild")
+    elif directoryEnum == ARTIFACT_CACHE:
+        return os.path.join(getDirectory(CACHE_ROOT), "artifacts")
+    elif directoryEnum == METADATA_CACHE:
+        return os.path.join(getDirectory(CACHE_ROOT), "metadata")
+    elif directoryEnum == PACKAGE_STORE:
+        return os.path.join(getDirectory(CACHE_ROOT), "store")
+    elif directoryEnum == EXTRACTED_DEPENDENCIES:
+        return os.path.join(getDirectory(WORKING), "extractedDependencies")
+    elif directoryEnum == COMPILER_CACHE:
+        return os.path.join(getDirectory(WORKING), "compilerCache")
+    elif directoryEnum == BUILD_DURATIONS:
+        return os.path.join(getDirectory(WORKING), "buildDurations.json")
+    elif directoryEnum == INSTALL_PREFIX:
+        return os.path.join(getDirectory(OUT_ROOT, configuration, projectName), "installPrefix")
     else:
         Utilities.failExecution("Unknown directoryEnum: [%s]" % directoryEnum)
@@ -1,64 +1,167 @@
 # SYSTEM IMPORTS
-
+import collections
 
 # PYTHON PROJECT IMPORTS
+import Utilities
 
 
+# the outgoing edges of a node are the names of the nodes that it depends on, so the incoming
+# edges of a node are the names of the nodes that depend on it. Every node has its own edge lists
+# and an edge is stored once, however often it is added (the sets next to the lists keep that
+# check constant time for nodes with many edges).
 class Node(object):
-    def __init__(self, name, incomingEdges=[], outgoingEdges=[], extraInfo={}):
+    __slots__ = ["_name", "_incomingEdges", "_outgoingEdges", "_incomingEdgeSet", "_outgoingEdgeSet", "_extraInfo"]
+
+    def __init__(self, name, incomingEdges=None, outgoingEdges=None, extraInfo=None):
         self._name = name
-        self._incomingEdges = incomingEdges
-        self._outgoingEdges = outgoingEdges
-        self._extraInfo = extraInfo
-        self._discoveryTime = 0
-        self._finishingTime = 0
-        self._color = "WHITE"
-        self._parent = None
+        self._incomingEdges = []
+        self._outgoingEdges = []
+        self._incomingEdgeSet = set()
+        self._outgoingEdgeSet = set()
+        self._extraInfo = extraInfo if extraInfo is not None else {}
+        for source in incomingEdges or []:
+            self.AddIncomingEdge(source)
+        for destination in outgoingEdges or []:
+            self.AddOutgoingEdge(destination)
+
+    def AddIncomingEdge(self, source):
+        if source not in self._incomingEdgeSet:
+            self._incomingEdgeSet.add(source)
+            self._incomingEdges.append(source)
+
+    def AddOutgoingEdge(self, destination):
+        if destination not in self._outgoingEdgeSet:
+            self._outgoingEdgeSet.add(destination)
+            self._outgoingEdges.append(destination)
 
 
 class Graph(object):
     def __init__(self):
         self._nodeMap = {}
+        # the sources of edges to nodes that have not been added yet (nodes can be added in
+        # any order). They become incoming edges when the node is added.
+        self._pendingIncomingEdges = {}
         self._topologicalOrder = []
 
-    def AddNode(self, name, incomingEdges=[], outgoingEdges=[], extraInfo={}):
-        self._nodeMap[name] = Node(name, extraInfo=extraInfo)
+    def AddNode(self, name, incomingEdges=None, outgoingEdges=None, extraInfo=None):
+        node = Node(name, incomingEdges=incomingEdges, outgoingEdges=outgoingEdges, extraInfo=extraInfo)
+        for source in self._pendingIncomingEdges.pop(name, []):
+            node.AddIncomingEdge(source)
+        self._nodeMap[name] = node
+        for destination in node._outgoingEdges:
+            self.LinkIncomingEdge(name, destination)
+        return node
 
     def AddEdge(self, source, destination):
-        self._nodeMap[source]._outgoingEdges.append(destination)
-        self._nodeMap[destination]._incomingEdges.append(source)
+        self._nodeMap[source].AddOutgoingEdge(destination)
+        self.LinkIncomingEdge(source, destination)
+
+    def LinkIncomingEdge(self, source, destination):
+        if destination in self._nodeMap:
+            self._nodeMap[destination].AddIncomingEdge(source)
+        else:
+            self._pendingIncomingEdges.setdefault(destination, []).append(source)
 
     def GetNode(self, name):
         return self._nodeMap[name]
 
-    def DepthFirstSearchVisit(self, node, time, onNodeFinish=None):
-        time += 1
-
-        # discover the node
-        node._discoveryTime = time
-        node._color = "GRAY"
-        for childName in node._outgoingEdges:
-            # visit all unvisited children
-            if self._nodeMap[childName]._color == "WHITE":
-                self._nodeMap[childName]._parent = node
-                self.DepthFirstSearchVisit(self._nodeMap[childName], time, onNodeFinish)
-
-        # finish the node
-        node._color = "BLACK"
-        time += 1
-        node._finishingTime = time
-        if onNodeFinish is not None:
-            onNodeFinish(node)
-
-    def DepthFirstSearch(self, onNodeFinish=None):
-        time = 0
-        for name, node in self._nodeMap.items():
-            if node._color == "WHITE":
-                self.DepthFirstSearchVisit(node, time, onNodeFinish)
+    # the names of the dependencies of a node that are in the graph
+    def GetDependencies(self, node):
+        return [name for name in node._outgoingEdges if name in self._nodeMap]
+
+    # every node in the graph, dependencies before the nodes that depend on them (Kahn's
+    # algorithm). Nodes that are ready at the same time are ordered by name so that the order
+    # is the same on every run. Fails the build with the offending path if there is a cycle.
+    def SortNodes(self):
+        nodeMap = self._nodeMap
+        remainingDeps = {}
+        readyNodes = collections.deque()
+        for name in sorted(nodeMap):
+            node = nodeMap[name]
+            remainingDeps[name] = len([dependency for dependency in node._outgoingEdges if dependency in nodeMap])
+            if remainingDeps[name] == 0:
+                readyNodes.append(node)
+
+        sortedNodes = []
+        while readyNodes:
+            node = readyNodes.popleft()
+            sortedNodes.append(node)
+            for dependent in node._incomingEdges:
+                remainingDeps[dependent] -= 1
+                if remainingDeps[dependent] == 0:
+                    readyNodes.append(nodeMap[dependent])
+
+        if len(sortedNodes) < len(self._nodeMap):
+            cycle = self.FindCycle([name for name in sorted(remainingDeps) if remainingDeps[name] > 0])
+            Utilities.failExecution("Dependency cycle: %s" % " -> ".join(cycle))
+        return sortedNodes
+
+    # returns a cycle [a, b, ..., a] among the nodes that could not be sorted. Every one of them
+    # still waits for a dependency that could not be sorted either, so following those
+    # dependencies from any of them has to end up in a cycle.
+    def FindCycle(self, unsortedNames):
+        unsorted = set(unsortedNames)
+        path = []
+        positions = {}
+        name = unsortedNames[0]
+        while name not in positions:
+            positions[name] = len(path)
+            path.append(name)
+            name = [dependency for dependency in self.GetDependencies(self._nodeMap[name])
+                    if dependency in unsorted][0]
+        return path[positions[name]:] + [name]
+
+    # the names of the nodes that depend on a node (also before that node is added)
+    def GetDependents(self, name):
+        if name in self._nodeMap:
+            return self._nodeMap[name]._incomingEdges
+        return self._pendingIncomingEdges.get(name, [])
+
+    # names and everything that they depend on, directly or not
+    def GetDependencyClosure(self, names):
+        return self.GetClosure(names, lambda name: self._nodeMap[name]._outgoingEdges if name in self._nodeMap else [])
+
+    # names and everything that depends on them, directly or not
+    def GetDependentClosure(self, names):
+        return self.GetClosure(names, self.GetDependents)
+
+    def GetClosure(self, names, getNeighbours):
+        closure = set(names)
+        pendingNames = list(closure)
+        while pendingNames:
+            for neighbour in getNeighbours(pendingNames.pop()):
+                if neighbour not in closure:
+                    closure.add(neighbour)
+                    pendingNames.append(neighbour)
+        return closure
+
+    # the critical path of building nodes (which have to be in build order, see TopologicalSort)
+    # when building a node takes costs[name]. Returns [pathCosts, criticalPath]: pathCosts[name]
+    # is the cost of the most expensive chain of nodes that starts with the node and runs through
+    # the nodes that depend on it, and criticalPath is the most expensive chain of all. No amount
+    # of parallelism builds the nodes faster than the cost of the critical path, and starting the
+    # nodes with the highest pathCosts first keeps the build as close to it as possible.
+    def CriticalPath(self, nodes, costs):
+        names = set([node._name for node in nodes])
+        pathCosts = {}
+        nextOnPath = {}
+        for node in reversed(nodes):
+            pathCosts[node._name] = costs[node._name]
+            for dependent in node._incomingEdges:
+                if dependent in names and costs[node._name] + pathCosts[dependent] > pathCosts[node._name]:
+                    pathCosts[node._name] = costs[node._name] + pathCosts[dependent]
+                    nextOnPath[node._name] = dependent
+
+        criticalPath = []
+        if len(nodes) > 0:
+            name = max(sorted(pathCosts), key=lambda name: pathCosts[name])
+            criticalPath.append(name)
+            while name in nextOnPath:
+                name = nextOnPath[name]
+                criticalPath.append(name)
+        return [pathCosts, criticalPath]
 
+    # the local packages in build order
     def TopologicalSort(self):
-        def addToTopologicalOrder(node):
-            if node._extraInfo["buildType"] == "local":
-                self._topologicalOrder.insert(0, node)
-        self.DepthFirstSearch(onNodeFinish=addToTopologicalOrder)
+        self._topologicalOrder = [node for node in self.SortNodes() if node._extraInfo["buildType"] == "local"]
         return self._topologicalOrder
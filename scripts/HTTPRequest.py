@@ -1,12 +1,20 @@
 # SYSTEM IMPORTS
+import ast
+import json
 import os
+import re
 import requests
 import sys
+import uuid
 
 # PYTHON PROJECT IMPORTS
+import MetadataCache
 import Utilities
 
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes
+
+
 def urljoin(url, *urls):
     urlList = [url]
     urlList.extend([urlPart for urlPart in urls])
@@ -15,95 +23,362 @@ def urljoin(url, *urls):
     return unrefinedUrl.replace("http:/", "http://")
 
 
+# a multipart/form-data body that is read from the file as it is sent instead of being
+# built in memory. Use it as the data of a request (it knows its length, so the request
+# has a Content-Length) and close it when done.
+class MultipartUpload(object):
+    def __init__(self, fields, fileFieldName, filePath, fileName):
+        self._boundary = uuid.uuid4().hex
+        head = b""
+        for key in sorted(fields.keys()):
+            head += ("--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n" %
+                     (self._boundary, key, fields[key])).encode("utf-8")
+        head += ("--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\n" %
+                 (self._boundary, fileFieldName, fileName)).encode("utf-8")
+        head += b"Content-Type: application/octet-stream\r\n\r\n"
+        self._parts = [head, None, ("\r\n--%s--\r\n" % self._boundary).encode("utf-8")]
+        self._file = open(filePath, "rb")
+        self._length = len(head) + os.path.getsize(filePath) + len(self._parts[2])
+
+    def getContentType(self):
+        return "multipart/form-data; boundary=%s" % self._boundary
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        data = b""
+        while len(data) < size and len(self._parts) > 0:
+            wanted = size - len(data)
+            if self._parts[0] is None:
+                chunk = self._file.read(wanted)
+                if len(chunk) == 0:
+                    self._parts.pop(0)
+            else:
+                chunk = self._parts[0][:wanted]
+                self._parts[0] = self._parts[0][wanted:]
+                if len(self._parts[0]) == 0:
+                    self._parts.pop(0)
+            data += chunk
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
 class HTTPRequest(object):
-    def __init__(self, baseUrl):
+    def __init__(self, baseUrl, maxConnections=8):
         self.user = os.environ.get("DBFILESERVER_USERNAME")
         self.pswrd = os.environ.get("DBFILESERVER_PASSWORD")
         self.baseUrl = baseUrl
 
-    def parseValue(self, stringValue):
-        if "u'" in stringValue:
-            return stringValue[2:-1]
-        elif "." in stringValue:
-            return float(stringValue)
-        else:
-            return int(stringValue)
-
-    def parseDict(self, dictData, keysToKeep, keysToIgnore):
+        # every request goes through one session so that connections (and their TCP/TLS
+        # setup) are kept alive and reused. The connection pool is shared between threads.
+        self.session = requests.Session()
+        self.session.auth = requests.auth.HTTPBasicAuth(self.user, self.pswrd)
+        self.setMaxConnections(maxConnections)
+        self.resolveSupported = True
+        self.metadataCache = None
+
+    def setMaxConnections(self, maxConnections):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=maxConnections, pool_maxsize=maxConnections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # removes the keys of a record that the caller is not interested in. relativeUrl, fileName
+    # and filetype are always kept because they are needed to download the record's file.
+    def filterRecord(self, record, keysToKeep, keysToIgnore):
         returnDict = {}
-        dictPairs = dictData.strip().split(",")
-        for pair in dictPairs:
-            key, value = pair.strip().split(":")
-            key = key[2:-1]  # all keys are strings so they have u'<key>'. Get rid of the u''
+        for key, value in record.items():
             if (key in keysToKeep and len(keysToKeep) > 0) or\
                (key not in keysToIgnore and len(keysToIgnore) > 0) or\
-               (key == "relativeUrl" or key == "fileName" or key == "filetype") and key != "_id":
-                returnDict[key] = self.parseValue(value.strip())
-
+               (key == "relativeUrl" or key == "fileName" or key == "filetype"):
+                returnDict[key] = value
         return returnDict
 
+    # parses the Python repr of a list of records that older servers answer queries with
+    # (for example [{u'fileName': u'a', u'build_num': 3}]). Mongo ObjectIds are not literals
+    # so they are turned into strings first.
     def parseQueryData(self, marshalledQueryData, keysToKeep, keysToIgnore):
+        if isinstance(marshalledQueryData, bytes):
+            marshalledQueryData = marshalledQueryData.decode("utf-8")
+        marshalledQueryData = re.sub(r"ObjectId\((u?'[0-9a-fA-F]*')\)", r"\1", marshalledQueryData)
+        try:
+            records = ast.literal_eval(marshalledQueryData.strip())
+        except (SyntaxError, ValueError):
+            Utilities.failExecution("Could not parse query response: %s" % marshalledQueryData[:200])
+        return [self.filterRecord(record, keysToKeep, keysToIgnore) for record in records]
+
+    # decodes a newline delimited JSON response (one record per line) as it arrives, so the
+    # whole response is never held in memory as text.
+    def parseStreamedQueryData(self, response, keysToKeep, keysToIgnore):
         parsedQueryData = []
-        marshalledQueryData = marshalledQueryData.replace("[", "").replace("]", "")
-        splitDictData = marshalledQueryData.split("},")
-        splitDictData[-1] = splitDictData[-1][:-1]
-        for dictData in splitDictData:
-            parsedQueryData.append(self.parseDict(dictData.strip()[1:], keysToKeep, keysToIgnore))
-
+        for line in response.iter_lines(chunk_size=64 * 1024):
+            if line.strip():
+                record = json.loads(line.decode("utf-8") if isinstance(line, bytes) else line)
+                parsedQueryData.append(self.filterRecord(record, keysToKeep, keysToIgnore))
         return parsedQueryData
 
-    def query(self, dbName, collectionName, dbParams={}, keysToKeep=[], keysToIgnore=[], hook=None):
-        auth = requests.auth.HTTPBasicAuth(self.user, self.pswrd)
+    # set cached=False for questions whose answer is expected to change during a build
+    def query(self, dbName, collectionName, dbParams={}, keysToKeep=[], keysToIgnore=[], hook=None, cached=True):
+        if self.metadataCache is None or not cached:
+            requestData = self.queryServer(dbName, collectionName, dbParams, keysToKeep, keysToIgnore)[0]
+        else:
+            requestData = self.queryCached(dbName, collectionName, dbParams, keysToKeep, keysToIgnore)
+        if hook is not None:
+            # the hook may change the list it is given. Don't let it change the cached answer.
+            requestData = hook(list(requestData))
+        return requestData
 
+    # answers a query from the metadata cache where possible (see MetadataCache)
+    def queryCached(self, dbName, collectionName, dbParams, keysToKeep, keysToIgnore):
+        key = MetadataCache.makeKey(self.baseUrl, "QUERY", dbName, collectionName, [dbParams, keysToKeep, keysToIgnore])
+        with self.metadataCache.getKeyLock(key):
+            entry = self.metadataCache.getMemoized(key)
+            if entry is not None:
+                return entry["records"]
+            entry = self.metadataCache.load(key)
+            if entry is not None and self.metadataCache.isFresh(entry):
+                self.metadataCache.memoize(key, entry)
+                return entry["records"]
+
+            try:
+                requestData, etag, lastModified = self.queryServer(dbName, collectionName, dbParams,
+                                                                   keysToKeep, keysToIgnore, entry)
+            except requests.exceptions.ConnectionError as e:
+                if entry is None:
+                    raise
+                print("Cannot reach %s (%s). Using cached answer for [%s]" % (self.baseUrl, e, collectionName))
+                self.metadataCache.memoize(key, entry)
+                return entry["records"]
+
+            if requestData is None:
+                # 304: the answer we have is still correct
+                return self.metadataCache.touch(key, entry)["records"]
+            if len(requestData) == 0:
+                # like unresolved packages, nothing is cached until the records have been uploaded
+                return requestData
+            return self.metadataCache.store(key, requestData, etag, lastModified)["records"]
+
+    # sends a query to the server. If cachedEntry is given, the query is conditional and
+    # None is returned for the records if the cached answer is still valid. Returns
+    # [records, ETag, Last-Modified].
+    def queryServer(self, dbName, collectionName, dbParams, keysToKeep, keysToIgnore, cachedEntry=None):
         finalDBParams = {("dbkey_%s" % key): dbParams[key] for key in dbParams.keys()}
         finalDBParams["dbName"] = dbName
         finalDBParams["collectionName"] = collectionName
-        queryResponse = requests.request("QUERY", self.baseUrl, data=finalDBParams, auth=auth)
+        headers = {"Accept": "application/x-ndjson"}
+        if cachedEntry is not None and cachedEntry.get("etag") is not None:
+            headers["If-None-Match"] = cachedEntry["etag"]
+        if cachedEntry is not None and cachedEntry.get("lastModified") is not None:
+            headers["If-Modified-Since"] = cachedEntry["lastModified"]
+        queryResponse = self.session.request("QUERY", self.baseUrl, data=finalDBParams, stream=True,
+                                             headers=headers)
+
+        try:
+            if queryResponse.status_code == 304 and cachedEntry is not None:
+                return [None, None, None]
+            if queryResponse.status_code != 200:
+                Utilities.failExecution("Error %s querying database: %s" % (queryResponse.status_code,
+                                                                            queryResponse.content))
+
+            # servers that do not speak newline delimited JSON answer with the repr of the records
+            if queryResponse.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+                requestData = self.parseStreamedQueryData(queryResponse, keysToKeep, keysToIgnore)
+            else:
+                requestData = self.parseQueryData(queryResponse.content, keysToKeep, keysToIgnore)
+        finally:
+            queryResponse.close()
+        return [requestData, queryResponse.headers.get("ETag"), queryResponse.headers.get("Last-Modified")]
+
+    # resolves the latest record (highest sortKey) for many collections in a single round trip.
+    # queries is a list of [collectionName, dbParams] pairs. Returns one record per query (None
+    # if nothing matched), in the same order. Servers that do not understand RESOLVE are asked
+    # one collection at a time instead.
+    def resolveLatest(self, dbName, queries, sortKey="build_num"):
+        if len(queries) == 0:
+            return []
+        if self.resolveSupported:
+            if self.metadataCache is None:
+                records = self.resolveServer(dbName, queries, sortKey)
+            else:
+                records = self.resolveCached(dbName, queries, sortKey)
+            if records is not None:
+                return records
+
+        def hook(records):
+            return sorted(records, key=lambda record: int(record[sortKey]))
+
+        records = []
+        for collectionName, dbParams in queries:
+            matchingRecords = self.query(dbName, collectionName, dbParams=dbParams, keysToKeep=[sortKey], hook=hook)
+            records.append(matchingRecords[-1] if len(matchingRecords) > 0 else None)
+        return records
+
+    # asks the server to resolve queries in one RESOLVE request. Returns None if the server
+    # does not support RESOLVE.
+    def resolveServer(self, dbName, queries, sortKey):
+        requestData = {
+            "dbName": dbName,
+            "sortKey": sortKey,
+            "queries": [{"collectionName": collectionName, "params": dbParams}
+                        for collectionName, dbParams in queries],
+        }
+        response = self.session.request("RESOLVE", self.baseUrl, data=json.dumps(requestData),
+                                        headers={"Content-Type": "application/json"})
+        if response.status_code in [400, 404, 405, 501]:
+            print("Server does not support RESOLVE (%s). Resolving packages one at a time" % response.status_code)
+            self.resolveSupported = False
+            return None
+        elif response.status_code != 200:
+            Utilities.failExecution("Error %s resolving packages: %s" % (response.status_code, response.content))
+
+        records = json.loads(response.content.decode("utf-8"))["results"]
+        for record in records:
+            if record is not None:
+                record.pop("_id", None)
+        return records
+
+    # resolves queries using the metadata cache where possible. Only the queries without a
+    # fresh answer are sent to the server. Packages that were not found are not cached so that
+    # they show up as soon as they are uploaded.
+    def resolveCached(self, dbName, queries, sortKey):
+        keys = [MetadataCache.makeKey(self.baseUrl, "RESOLVE", dbName, collectionName, [dbParams, sortKey])
+                for collectionName, dbParams in queries]
+        records = [None] * len(queries)
+        entries = [None] * len(queries)
+        missing = []
+        for index, key in enumerate(keys):
+            entry = self.metadataCache.getMemoized(key)
+            if entry is None:
+                entry = self.metadataCache.load(key)
+                if entry is not None and self.metadataCache.isFresh(entry):
+                    self.metadataCache.memoize(key, entry)
+                else:
+                    missing.append(index)
+            entries[index] = entry
+            records[index] = entry["records"] if entry is not None else None
+        if len(missing) == 0:
+            return records
+
+        try:
+            resolved = self.resolveServer(dbName, [queries[index] for index in missing], sortKey)
+        except requests.exceptions.ConnectionError:
+            if len([index for index in missing if entries[index] is None]) > 0:
+                # the cached answers of the per package queries may still get us through
+                print("Cannot reach %s. Resolving packages from cached queries" % self.baseUrl)
+                return None
+            print("Cannot reach %s. Using cached package resolutions" % self.baseUrl)
+            return records
+        if resolved is None:
+            return None
+
+        for index, record in zip(missing, resolved):
+            records[index] = record
+            if record is not None:
+                self.metadataCache.store(keys[index], record)
+        return records
 
-        if queryResponse.status_code != 200:
-            Utilities.failExecution("Error querying database %s" % (queryResponse.status_code,
-                                                                    queryResponse.content))
+    def download(self, receivingDirPath, dbName, collectionName, urlParams=[],
+                 dbParams={}, keysToKeep=[], keysToIgnore=[], fileChunkSize=DOWNLOAD_CHUNK_SIZE, readBytes=True,
+                 hook=None):
+        requestData = self.query(dbName, collectionName, dbParams=dbParams,
+                                 keysToKeep=keysToKeep, keysToIgnore=keysToIgnore, hook=hook)
 
-        requestData = self.parseQueryData(queryResponse.content, keysToKeep, keysToIgnore)
-        if hook is not None:
-            requestData = hook(requestData)
+        for fileToDownload in requestData:
+            self.downloadRecord(receivingDirPath, fileToDownload, fileChunkSize=fileChunkSize, readBytes=readBytes)
         return requestData
 
-    def download(self, receivingDirPath, dbName, collectionName, urlParams=[],
-                 dbParams={}, keysToKeep=[], keysToIgnore=[], fileChunkSize=1, readBytes=True, hook=None):
-        url = None
-        if len(urlParams) == 0:
-            url = self.baseUrl
+    # downloads the file described by a record returned from query(). The file is streamed
+    # to "<fileName>.part" in chunks of fileChunkSize bytes and renamed once it is complete,
+    # so a file with the final name is always whole. If a ".part" file is left over from an
+    # interrupted download, only the rest of the file is requested (HTTP Range). The ETag (or
+    # Last-Modified) of the file is kept next to the ".part" file and sent along (If-Range), so
+    # the server sends the whole file again if it changed in the meantime.
+    def downloadRecord(self, receivingDirPath, fileToDownload, fileChunkSize=DOWNLOAD_CHUNK_SIZE, readBytes=True,
+                       resume=True):
+        url = fileToDownload["relativeUrl"]
+        if "http" not in url:
+            url = urljoin(self.baseUrl, url)
+        fileName = fileToDownload["fileName"] + fileToDownload["filetype"]
+        filePath = os.path.join(receivingDirPath, fileName)
+        partialFilePath = filePath + ".part"
+        validatorPath = partialFilePath + ".validator"
+
+        currentBytes = 0
+        # ask for the bytes as they are stored so that Content-Length is the size of the file
+        headers = {"Accept-Encoding": "identity"}
+        if resume and os.path.exists(partialFilePath) and os.path.exists(validatorPath):
+            currentBytes = os.path.getsize(partialFilePath)
+            with open(validatorPath, "r") as f:
+                headers["If-Range"] = f.read().strip()
+            headers["Range"] = "bytes=%s-" % currentBytes
+        response = self.session.get(url, stream=True, headers=headers)
+        if response.status_code == 416:
+            # the partial file does not fit the file on the server anymore. Start over.
+            response.close()
+            currentBytes = 0
+            response = self.session.get(url, stream=True, headers={"Accept-Encoding": "identity"})
+
+        if response.status_code == 206:
+            print("Resuming download of %s at byte %s" % (fileName, currentBytes))
+            openMode = "ab" if readBytes else "a"
+        elif response.status_code == 200:
+            # the server ignored the range, the file changed (If-Range) or no range was asked for
+            currentBytes = 0
+            openMode = "wb" if readBytes else "w"
+            validator = self.getValidator(response)
+            if validator is not None:
+                with open(validatorPath, "w") as f:
+                    f.write(validator + "\n")
+            else:
+                Utilities.removeFile(validatorPath)
         else:
-            url = urljoin(self.baseUrl, *urlParams)
-        auth = requests.auth.HTTPBasicAuth(self.user, self.pswrd)
+            response.close()
+            Utilities.failExecution("Error %s downloading %s" % (response.status_code, url))
 
-        requestData = self.query(dbName, collectionName, dbParams=dbParams,
-                                 keysToKeep=keysToKeep, keysToIgnore=keysToIgnore, hook=hook)
+        numBytes = None
+        if response.headers.get("Content-Length") is not None:
+            numBytes = currentBytes + int(response.headers["Content-Length"])
+        print("Starting download of %s (%s bytes)" % (fileName, numBytes if numBytes is not None else "unknown"))
 
-        for fileToDownload in requestData:
-            url = fileToDownload["relativeUrl"]
-            if "http" not in url:
-                url = urljoin(self.baseUrl, url)
-            response = requests.get(url, stream=True, auth=auth)
-
-            if response.status_code != 200:
-                Utilities.failExecution("Error %s downloading %s" % (response.status_code, url))
-
-            numBytes = len(response.content)
-            currentBytes = 0.0
-            minPercentToPrint = 0
-            print("Starting download (%s bytes):" % numBytes)
-            with open(os.path.join(receivingDirPath, fileToDownload["fileName"] +
-                                   fileToDownload["filetype"]), ("wb" if readBytes else "w")) as f:
+        percentToPrint = 10
+        try:
+            with open(partialFilePath, openMode) as f:
                 for chunk in response.iter_content(fileChunkSize):
-                    if currentBytes/numBytes >= minPercentToPrint:
-                        print("[%s%%]" % int(currentBytes/numBytes * 100)),
-                        minPercentToPrint += 0.1
                     f.write(chunk)
                     currentBytes += len(chunk)
-            print("Download done")
-        return requestData
+                    if numBytes is not None and numBytes > 0 and currentBytes * 100 >= percentToPrint * numBytes:
+                        print("%s [%s%%]" % (fileName, currentBytes * 100 // numBytes))
+                        percentToPrint = (currentBytes * 100 // numBytes // 10 + 1) * 10
+        finally:
+            response.close()
+
+        if numBytes is not None and currentBytes != numBytes:
+            # keep the partial file so that the next attempt can resume
+            Utilities.failExecution("Download of %s is incomplete (%s of %s bytes)" % (url, currentBytes, numBytes))
+        if os.path.exists(filePath):
+            os.remove(filePath)
+        os.rename(partialFilePath, filePath)
+        Utilities.removeFile(validatorPath)
+        print("Download of %s done" % fileName)
+
+    # the value of If-Range that resumes a download of the file of response only if the file is
+    # still the same, or None if the server sent no validator that can be used for it (weak ETags
+    # cannot).
+    def getValidator(self, response):
+        etag = response.headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            return etag
+        return response.headers.get("Last-Modified")
 
     def upload(self, filePath, dbName, collectionName, fileName="", dbParams={}, urlParams=[]):
         fullFilePath = None
@@ -125,8 +400,10 @@ class HTTPRequest(object):
         finalDBParams["dbName"] = dbName
         finalDBParams["collectionName"] = collectionName
         # to post, do I have to add "/post" to the end of the url?
-        response = requests.request("QUERY_POST", url, files={"upload_file": open(fullFilePath, 'rb')},
-                                    data=finalDBParams, auth=requests.auth.HTTPBasicAuth(self.user, self.pswrd))
+        # the file is streamed from disk as it is sent (see MultipartUpload)
+        with MultipartUpload(finalDBParams, "upload_file", fullFilePath, fileName) as uploadBody:
+            response = self.session.request("QUERY_POST", url, data=uploadBody,
+                                            headers={"Content-Type": uploadBody.getContentType()})
 
         # handle response
         if response.status_code != 200:
@@ -136,7 +413,7 @@ class HTTPRequest(object):
     def delete(self, urlParams=[]):
         fullUrlPath = self.baseUrl if len(urlParams) == 0 else urljoin(self.baseUrl, *urlParams)
 
-        response = requests.delete(fullUrlPath, auth=requests.auth.HTTPBasicAuth(self.user, self.pswrd))
+        response = self.session.delete(fullUrlPath)
         if response.status_code != 200:
             Utilities.failExecution("Error %s deleting file at url %s" % (response.status_code,
                                                                           fullUrlPath))
@@ -150,7 +427,7 @@ class HTTPRequest(object):
     def listUrlContents(self, urlParams=[]):
         fullUrlPath = self.baseUrl if len(urlParams) == 0 else urljoin(self.baseUrl, *urlParams)
 
-        response = requests.request("LIST", fullUrlPath, auth=requests.auth.HTTPBasicAuth(self.user, self.pswrd))
+        response = self.session.request("LIST", fullUrlPath)
         if response.status_code != 200:
             Utilities.failExecution("Error %s listing contents of %s" % (response.status_code,
                                                                          fullUrlPath))
@@ -162,8 +439,7 @@ class HTTPRequest(object):
     def customRequest(self, requestName, uploadFiles={}, requestData={}, urlParams=[]):
         fullUrlPath = self.baseUrl if len(urlParams) == 0 else urljoin(self.baseUrl, *urlParams)
 
-        response = requests.request(requestName, fullUrlPath, files=uploadFiles, data=requestData,
-                                    auth=requests.auth.HTTPBasicAuth(self.user, self.pswrd))
+        response = self.session.request(requestName, fullUrlPath, files=uploadFiles, data=requestData)
         if response.status_code != 200:
             Utilities.failExecution("Error %s executing [%s]: %s" % (response.status_code,
                                                                      requestName, fullUrlPath))
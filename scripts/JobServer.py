@@ -0,0 +1,49 @@
+# SYSTEM IMPORTS
+import errno
+import os
+
+# PYTHON PROJECT IMPORTS
+
+
+def isSupported():
+    return os.name == "posix"
+
+
+# a GNU make jobserver. The jobserver is a pipe that holds one token per job that may run.
+# Every make process that is started with getMakeFlags() in its environment shares the
+# tokens in the pipe, so the number of compiler processes across every package that is
+# building at the same time stays within numJobs.
+#
+# make always runs one job without taking a token from the pipe (its "implicit" token).
+# To keep that job inside the budget as well, acquire() a token before starting make and
+# release() it when make is done: that token is the one that make uses implicitly.
+class JobServer(object):
+    def __init__(self, numJobs):
+        self._numJobs = max(1, int(numJobs))
+        # the child make processes inherit these file descriptors.
+        self._readFd, self._writeFd = os.pipe()
+        os.write(self._writeFd, b"+" * self._numJobs)
+
+    def getMakeFlags(self):
+        # make < 4.2 understands --jobserver-fds, make >= 4.2 understands --jobserver-auth.
+        return " -j --jobserver-fds=%d,%d --jobserver-auth=%d,%d" % (self._readFd, self._writeFd,
+                                                                     self._readFd, self._writeFd)
+
+    # blocks until a token is available
+    def acquire(self):
+        while True:
+            try:
+                token = os.read(self._readFd, 1)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if len(token) == 1:
+                return token
+
+    def release(self, token):
+        os.write(self._writeFd, token)
+
+    def close(self):
+        os.close(self._readFd)
+        os.close(self._writeFd)
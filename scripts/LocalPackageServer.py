@@ -0,0 +1,175 @@
+# SYSTEM IMPORTS
+import cgi
+import hashlib
+import json
+import os
+import sys
+import threading
+
+if sys.version_info[0] < 3:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+# PYTHON PROJECT IMPORTS
+import PackageStore
+
+
+# a stand in for the package server that serves a PackageStore. It speaks the same protocol
+# as the real server (QUERY, QUERY_POST, GET, LIST, DELETE and RESOLVE) and is meant for
+# testing rbuild without a server. Authentication is not checked.
+#
+#   python LocalPackageServer.py <storeDir> [port]
+#
+# and point FILESERVER_URI at http://localhost:<port>/
+class LocalPackageRequestHandler(BaseHTTPRequestHandler):
+    def getStore(self):
+        return self.server.store
+
+    def getRelativePath(self):
+        return urlparse(self.path).path.lstrip("/")
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def readForm(self):
+        form = parse_qs(self.readBody().decode("utf-8"), keep_blank_values=True)
+        return {key: values[-1] for key, values in form.items()}
+
+    def getDBParams(self, form):
+        return {key[len("dbkey_"):]: value for key, value in form.items() if key.startswith("dbkey_")}
+
+    def sendBody(self, statusCode, body, contentType="text/plain", headers={}):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        self.send_response(statusCode)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # answers with one JSON record per line if the client accepts it, otherwise with the repr
+    # of the list of records like older servers do.
+    def do_QUERY(self):
+        form = self.readForm()
+        records = self.getStore().query(form["dbName"], form["collectionName"], self.getDBParams(form))
+        # the ETag lets clients revalidate a cached answer (If-None-Match) without receiving it again
+        etag = '"%s"' % hashlib.sha1(json.dumps(records, sort_keys=True).encode("utf-8")).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.sendBody(304, "", headers={"ETag": etag})
+        elif "application/x-ndjson" in self.headers.get("Accept", ""):
+            self.sendBody(200, "".join([json.dumps(record) + "\n" for record in records]),
+                          contentType="application/x-ndjson", headers={"ETag": etag})
+        else:
+            self.sendBody(200, str(records), headers={"ETag": etag})
+
+    # resolves the latest record of many collections in one request. The body is
+    #   {"dbName": ..., "sortKey": ..., "queries": [{"collectionName": ..., "params": {...}}, ...]}
+    # and the answer is {"results": [<record or null>, ...]} in the same order.
+    def do_RESOLVE(self):
+        request = json.loads(self.readBody().decode("utf-8"))
+        results = [self.getStore().resolveLatest(request["dbName"], query["collectionName"],
+                                                 query.get("params", {}), request.get("sortKey", "build_num"))
+                   for query in request["queries"]]
+        self.sendBody(200, json.dumps({"results": results}), contentType="application/json")
+
+    def do_GET(self):
+        filePath = self.getStore().getFilePath(self.getRelativePath())
+        if not os.path.isfile(filePath):
+            self.sendBody(404, "%s not found" % self.path)
+            return
+
+        fileStat = os.stat(filePath)
+        fileSize = fileStat.st_size
+        # the ETag changes with the file, so a client resuming a download (Range with If-Range)
+        # gets the whole file again if the file was replaced since it started.
+        etag = '"%x-%x"' % (fileSize, int(fileStat.st_mtime * 1000000))
+        start = 0
+        rangeHeader = self.headers.get("Range")
+        if self.headers.get("If-Range") not in [None, etag]:
+            rangeHeader = None
+        if rangeHeader is not None and rangeHeader.startswith("bytes=") and rangeHeader.endswith("-"):
+            start = int(rangeHeader[len("bytes="):-1])
+            if start >= fileSize:
+                self.sendBody(416, "range not satisfiable", headers={"Content-Range": "bytes */%s" % fileSize})
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (start, fileSize - 1, fileSize))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(fileSize - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        with open(filePath, "rb") as f:
+            f.seek(start)
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                self.wfile.write(chunk)
+
+    def do_QUERY_POST(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={"REQUEST_METHOD": "POST",
+                                         "CONTENT_TYPE": self.headers.get("Content-Type")})
+        fields = {key: form.getvalue(key) for key in form.keys() if key != "upload_file"}
+        if "upload_file" in form and form["upload_file"].filename:
+            filePath = self.getStore().getFilePath(os.path.join(self.getRelativePath(),
+                                                                os.path.basename(form["upload_file"].filename)))
+            if not os.path.exists(os.path.dirname(filePath)):
+                os.makedirs(os.path.dirname(filePath))
+            with open(filePath, "wb") as f:
+                for chunk in iter(lambda: form["upload_file"].file.read(1024 * 1024), b''):
+                    f.write(chunk)
+        dbParams = self.getDBParams(fields)
+        if len(dbParams) > 0:
+            self.getStore().addRecord(fields["dbName"], fields["collectionName"], dbParams)
+        self.sendBody(200, "ok")
+
+    def do_LIST(self):
+        dirPath = self.getStore().getFilePath(self.getRelativePath() + "/.")
+        if not os.path.isdir(dirPath):
+            self.sendBody(404, "%s not found" % self.path)
+            return
+        self.sendBody(200, "\n".join(sorted(os.listdir(dirPath))))
+
+    def do_DELETE(self):
+        filePath = self.getStore().getFilePath(self.getRelativePath())
+        if not os.path.isfile(filePath):
+            self.sendBody(404, "%s not found" % self.path)
+            return
+        os.remove(filePath)
+        self.sendBody(200, "ok")
+
+
+class LocalPackageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, storeDir, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), LocalPackageRequestHandler)
+        self.store = PackageStore.PackageStore(storeDir)
+
+    def getUrl(self):
+        return "http://127.0.0.1:%s/" % self.server_address[1]
+
+
+# starts a server on a background thread and returns it. Call shutdown() when done.
+def start(storeDir, port=0):
+    server = LocalPackageServer(storeDir, port)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    return server
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: %s <storeDir> [port]" % sys.argv[0])
+        sys.exit(1)
+    server = LocalPackageServer(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+    print("serving %s at %s" % (sys.argv[1], server.getUrl()))
+    server.serve_forever()
@@ -1,16 +1,31 @@
 
 # SYSTEM IMPORTS
+import collections
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import platform
-import tarfile
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 # PYTHON PROJECT IMPORTS
+import ArtifactCache
+import BuildCache
+import CompilerCache
+import ExtractionCache
 import Utilities
 import FileSystem
 # import DBManager
 import Graph
 # import HTTPRequest
+import JobServer
+import MetadataCache
+import PackageStore
+import PackageStoreRequest
+import Scheduler
 
 
 # the parent class of the build process. It contains methods common to all build processes as well
@@ -21,6 +36,9 @@ class MetaBuild(object):
         self._project_namespace = ""
         self._source_dirs = ["cpp"]
         self._build_steps = []
+        # the build steps whose only output is the OUT_ROOT of a package. With -build_cache
+        # they are skipped when the output of the package is in the build cache.
+        self._cacheable_build_steps = []
         self._project_build_number = "0.0.0.0"  # major.minor.patch.build
         self._configurations = ["debug", "release"]
         self._build_directory = FileSystem.getDirectory(FileSystem.WORKING)
@@ -31,6 +49,47 @@ class MetaBuild(object):
         self._buildGraph = Graph.Graph()
         self._globalDeps = {}
         self._aggregatedGlobalDeps = {}
+        self._fingerprints = {}
+        self._artifactCache = None
+        self._packageStore = None
+        self._extractionCache = None
+        self._stagingMode = "copy"
+        self._packageFormat = "tar.gz"
+        self._uploadPool = None
+        self._pendingUploads = []
+        self._buildCache = None
+        self._compilerCache = None
+        # {configuration: {package: seconds}} of the packages that were built before
+        self._buildDurations = {}
+        self._buildDurationsLock = threading.Lock()
+        self._downloadJobs = 8
+        self._jobServer = None
+        self._buildJobsPerPackage = 1
+        self._loadAverage = None
+        self._threadState = threading.local()
+        self._outputLock = threading.Lock()
+        # the cmake directory of the workspace is shared by every package (see stageDependency)
+        self._cmakeStagingLock = threading.Lock()
+
+    # the custom args contain the node that is currently being built. Packages can be
+    # built concurrently so every thread keeps its own copy.
+    @property
+    def _custom_args(self):
+        return getattr(self._threadState, "customArgs", {})
+
+    @_custom_args.setter
+    def _custom_args(self, customArgs):
+        self._threadState.customArgs = customArgs
+
+    # the configuration that is currently being built. Configurations can be
+    # built concurrently so every thread keeps its own.
+    @property
+    def _config(self):
+        return getattr(self._threadState, "config", None)
+
+    @_config.setter
+    def _config(self, config):
+        self._threadState.config = config
 
     def findProjectsInWorkspace(self):
         workspaceDir = FileSystem.getDirectory(FileSystem.WORKSPACE_DIR)
@@ -48,6 +107,61 @@ class MetaBuild(object):
                     packagesToBuild[subdir] = fullSubDirPath
         return packagesToBuild
 
+    # restricts the packages found in the workspace (directory name -> path) to the ones that
+    # have to be built for -packages and -affected_by. Only package.xml files are read here, so
+    # the packages that are left out never resolve or download their dependencies.
+    #   -packages=a,b       a, b and the local packages that they depend on (directly or not)
+    #   -affected_by=x      the local packages that depend on x (directly or not) and the local
+    #                       packages that those depend on. x can be a local or an external package.
+    def selectPackagesToBuild(self, packagesToBuild):
+        targets = self.getPackageListArg("packages")
+        affectedBy = self.getPackageListArg("affected_by") or self.getPackageListArg("affected-by")
+        if targets is None and affectedBy is None:
+            return packagesToBuild
+
+        workspaceGraph = Graph.Graph()
+        packageDirs = {}
+        for packageDirName, packagePath in packagesToBuild.items():
+            packageName, packageDeps = self.readPackageDependencies(packagePath)
+            packageDirs[packageName] = packageDirName
+            workspaceGraph.AddNode(packageName, outgoingEdges=packageDeps)
+
+        selected = set(packageDirs)
+        if targets is not None:
+            for target in targets:
+                if target not in packageDirs:
+                    Utilities.failExecution("Package [%s] is not in the workspace" % target)
+            selected = workspaceGraph.GetDependencyClosure(targets) & selected
+        if affectedBy is not None:
+            for changedPackage in affectedBy:
+                if changedPackage not in packageDirs and len(workspaceGraph.GetDependents(changedPackage)) == 0:
+                    Utilities.failExecution("No package in the workspace depends on [%s]" % changedPackage)
+            affected = workspaceGraph.GetDependentClosure(affectedBy) & selected
+            selected = workspaceGraph.GetDependencyClosure(affected) & selected
+
+        print("Building %s of %s packages: %s" % (len(selected), len(packagesToBuild), ", ".join(sorted(selected))))
+        return {packageDirs[packageName]: packagesToBuild[packageDirs[packageName]] for packageName in selected}
+
+    # a comma separated list of packages given as -<argName>=a,b (or None)
+    def getPackageListArg(self, argName):
+        if argName not in self._custom_args:
+            return None
+        if self._custom_args[argName] is True:
+            Utilities.failExecution("-%s needs a list of packages (-%s=a,b)" % (argName, argName))
+        return [package.strip() for package in self._custom_args[argName].split(",") if package.strip() != ""]
+
+    # the name of a package and the names of every package it depends on (local or not)
+    def readPackageDependencies(self, packagePath):
+        root = ET.parse(os.path.join(packagePath, "package.xml")).getroot()
+        packageName = os.path.basename(packagePath)
+        packageDeps = []
+        for childElement in root:
+            if "name" == childElement.tag:
+                packageName = childElement.text
+            elif "robos_package_dependency" == childElement.tag:
+                packageDeps.append(childElement.text)
+        return packageName, packageDeps
+
     def packageAvailable(self, packageName, configs):
         # self._dbManager.openCollection("available_packages")
         val = True
@@ -59,12 +173,17 @@ class MetaBuild(object):
             }
             val = val and (len(self._httpRequest.query("packages", "available_packages",
                                                        dbParams=dbParams)) > 0)
+            if val and self._packageStore is not None:
+                self._packageStore.addRecordIfMissing("packages", "available_packages", dbParams)
         return val
 
-    def parsePackageFile(self, buildTag, packageFilePath, depsToDownload):
-        tree = ET.parse(packageFilePath)
+    # parses a package.xml. New external dependencies (ones that are not built here and have not
+    # been asked for yet) are added to depsToDownload. If packageFile is given, the package.xml is
+    # read from it and packageFilePath is only used in messages.
+    def parsePackageFile(self, buildTag, packageFilePath, depsToDownload, packageFile=None):
+        tree = ET.parse(packageFile if packageFile is not None else packageFilePath)
         root = tree.getroot()
-        packageDict = {}
+        packageDict = {"externalDeps": []}
         packageName = None
         packageDeps = []
         if root.tag != "package":
@@ -74,21 +193,18 @@ class MetaBuild(object):
             if "name" == childElement.tag:
                 packageName = childElement.text
             elif "robos_package_dependency" == childElement.tag:
-                if childElement.text not in self._packages_to_build and\
-                   self.packageAvailable(childElement.text, ["release"]) and\
-                   childElement.text not in depsToDownload and childElement.text not in self._aggregatedGlobalDeps:
+                if childElement.text in self._packages_to_build:
+                    packageDeps.append(childElement.text)
+                elif childElement.text in depsToDownload or childElement.text in self._aggregatedGlobalDeps:
+                    # another package already asked for this dep
+                    packageDeps.append(childElement.text)
+                    packageDict["externalDeps"].append(childElement.text)
+                elif self.packageAvailable(childElement.text, ["release"]):
                     # download this dep
                     print("appending package [%s] for download" % childElement.text)
                     depsToDownload[childElement.text] = None
                     packageDeps.append(childElement.text)
-                    if "externalDeps" not in packageDict:
-                        packageDict["externalDeps"] = [childElement.text]
-                    else:
-                        packageDict["externalDeps"].append(childElement.text)
-                elif childElement.text in self._packages_to_build:
-                    packageDeps.append(childElement.text)
-                elif childElement.text in self._aggregatedGlobalDeps:
-                    continue
+                    packageDict["externalDeps"].append(childElement.text)
                 else:
                     Utilities.failExecution(("Not sure what to do with package dependency: %s. " +
                                             "Cannot download it and it is not present on system") % childElement.text)
@@ -109,6 +225,13 @@ class MetaBuild(object):
             self._buildGraph.AddNode(packageNameAndBuildType[0],
                                      outgoingEdges=packageDeps, extraInfo=packageInfo)
 
+    # downloads every external package that the local packages depend on, directly or not, and
+    # adds them to the build graph. The dependencies of a package are only known once its
+    # package.xml has been read, so the packages are found in waves. Downloads run on a pool of
+    # threads and a package is parsed as soon as its own download is done: the dependencies it
+    # adds are resolved and start downloading straight away, while the rest of its wave is
+    # still downloading. Only package.xml is read from each archive (they are extracted when
+    # they are needed by loadDependencies).
     def loadGlobalPackageDependencies(self):
         print("loading global packages")
         globalDepsDir = FileSystem.getDirectory(FileSystem.GLOBAL_DEPENDENCIES)
@@ -117,53 +240,96 @@ class MetaBuild(object):
         if not os.path.exists(globalDepsDir):
             Utilities.mkdir(globalDepsDir)
 
-        def hook(records):
-            return [sorted(records, key=lambda record: int(record["build_num"]))[-1]]
+        dbParams = {
+            "config": "release",
+            "OS": platform.system().lower(),
+        }
+        pendingPackages = collections.deque()
+        downloadPool = Utilities.WorkerPool(self._downloadJobs)
+        try:
+            self.startPackageDownloads(downloadPool, globalDepsDir, dbParams, self._globalDeps, pendingPackages)
+            while len(pendingPackages) > 0:
+                package, packageFile = pendingPackages.popleft()
+                packageXml = packageFile.get()
+                packagePath = os.path.join(globalDepsDir,
+                                           Utilities.stripArchiveExtension(self._aggregatedGlobalDeps[package]))
+                newDeps = {}
+                packageNameAndBuildType, packageDeps, packageInfo =\
+                    self.parsePackageFile("external", os.path.join(packagePath, "package.xml"), newDeps,
+                                          packageFile=io.BytesIO(packageXml))
+                if packageNameAndBuildType[0] not in self._buildGraph._nodeMap:
+                    packageInfo["packageMainPath"] = packagePath
+                    packageInfo["buildType"] = packageNameAndBuildType[1]
+                    self._buildGraph.AddNode(packageNameAndBuildType[0],
+                                             outgoingEdges=packageDeps, extraInfo=packageInfo)
+                self.startPackageDownloads(downloadPool, globalDepsDir, dbParams, newDeps, pendingPackages)
+        finally:
+            downloadPool.close()
 
-        for package in self._globalDeps:
-            print("Resolving dependency [%s]" % package),
-            # self._dbManager.openCollection(package)
-            dbParams = {
-                "config": "release",
-                "OS": platform.system().lower(),
-            }
-            mostRecentRecord = self._httpRequest.download(globalDepsDir, "packages",
-                                                          package, dbParams=dbParams,
-                                                          keysToKeep=["build_num"], hook=hook)[0]
-            # self._httpRequest.download(os.path.join(globalDepsDir, mostRecentRecord["fileName"] +
-            #                            mostRecentRecord["filetype"]),
-            #                            urlParams=[mostRecentRecord["relativeUrl"]])
+    # resolves the latest version of packages with one request and starts downloading them.
+    # Appends [package, result of readPackageFile] to pendingPackages for every package.
+    def startPackageDownloads(self, downloadPool, globalDepsDir, dbParams, packages, pendingPackages):
+        packages = list(packages)
+        if len(packages) == 0:
+            return
+        print("Resolving dependencies %s" % packages)
+        mostRecentRecords = self._httpRequest.resolveLatest("packages", [[package, dbParams] for package in packages])
+        for package, mostRecentRecord in zip(packages, mostRecentRecords):
+            if mostRecentRecord is None:
+                Utilities.failExecution("No %s build of package [%s] found for %s" %
+                                        (dbParams["config"], package, dbParams["OS"]))
             self._aggregatedGlobalDeps[package] = mostRecentRecord["fileName"] + mostRecentRecord["filetype"]
-            self._globalDeps[package] = mostRecentRecord["fileName"] + mostRecentRecord["filetype"]
-
-    def continueLoadingDependencies(self):
-        # parse downloaded packages.xml files and determine if there are unresolved dependencies.
-        # return True if there are more dependencies to download or False if all requirements
-        # are met.
-        numDeps = len(self._aggregatedGlobalDeps)
-        if numDeps > 0 and len(self._aggregatedGlobalDeps) == 0:
-            self._aggregatedGlobalDeps = self._globalDeps
-        tmpGlobalDeps = self._globalDeps
-        self._globalDeps = {}
-        globalDepsDir = FileSystem.getDirectory(FileSystem.GLOBAL_DEPENDENCIES)
-        for name, packageTarGzName in tmpGlobalDeps.items():
-            packageTarGzPath = os.path.join(globalDepsDir, packageTarGzName)
-            # open all .tar.gz files and extract contents to that directory
-            packagePath = packageTarGzPath.replace(".tar.gz", "")
-            with tarfile.open(packageTarGzPath, "r:gz") as tarFile:
-                tarFile.extractall(globalDepsDir)
-            packageNameAndBuildType, packageDeps, packageInfo =\
-                self.parsePackageFile("external", os.path.join(packagePath, "package.xml"), self._globalDeps)
-            if packageNameAndBuildType[0] not in self._buildGraph._nodeMap:
-                packageInfo["packageMainPath"] = packagePath
-                packageInfo["buildType"] = packageNameAndBuildType[1]
-                self._buildGraph.AddNode(packageNameAndBuildType[0],
-                                         outgoingEdges=packageDeps, extraInfo=packageInfo)
-
-        for newPackageDep in self._globalDeps.keys():
-            if newPackageDep not in self._aggregatedGlobalDeps:
-                self._aggregatedGlobalDeps[newPackageDep] = self._globalDeps[newPackageDep]
-        return len(self._aggregatedGlobalDeps) > numDeps
+        for package, mostRecentRecord in zip(packages, mostRecentRecords):
+            pendingPackages.append([package, downloadPool.submit(self.downloadAndReadPackageFile, globalDepsDir,
+                                                                 package, dbParams, mostRecentRecord)])
+
+    def downloadAndReadPackageFile(self, globalDepsDir, package, dbParams, record):
+        self.downloadPackage(globalDepsDir, package, dbParams, record)
+        return self.readPackageFile(os.path.join(globalDepsDir, record["fileName"] + record["filetype"]))
+
+    # returns the contents of package.xml from a package archive without extracting the archive
+    def readPackageFile(self, packageTarGzPath):
+        memberName = Utilities.stripArchiveExtension(os.path.basename(packageTarGzPath)) + "/package.xml"
+        with Utilities.openArchive(packageTarGzPath) as tarFile:
+            for member in tarFile:
+                if member.name == memberName:
+                    return tarFile.extractfile(member).read()
+        Utilities.failExecution("%s does not contain %s" % (packageTarGzPath, memberName))
+
+    # downloads the archive of a resolved package record into receivingDirPath unless
+    # that version is already in the artifact cache.
+    def downloadPackage(self, receivingDirPath, packageName, dbParams, record):
+        archivePath = os.path.join(receivingDirPath, record["fileName"] + record["filetype"])
+        if self._artifactCache is None:
+            self._httpRequest.downloadRecord(receivingDirPath, record)
+        else:
+            cacheKey = ArtifactCache.makeKey(packageName, dbParams["config"], dbParams["OS"], record["build_num"])
+            if self._artifactCache.get(cacheKey, archivePath):
+                print("Using cached archive for [%s]" % cacheKey)
+            else:
+                # the archive may be a hard link into the cache. Never write through it.
+                if os.path.exists(archivePath):
+                    Utilities.rmTree(archivePath)
+                self._httpRequest.downloadRecord(receivingDirPath, record)
+                self._artifactCache.put(cacheKey, archivePath)
+        self.seedPackageStore(packageName, dbParams, record, archivePath)
+
+    # with -seed_package_store, every package that a build resolves is also put in the local
+    # package store so that later builds can run -offline.
+    def seedPackageStore(self, packageName, dbParams, record, archivePath):
+        if self._packageStore is None:
+            return
+        storedRecord = dict(dbParams)
+        storedRecord.update(record)
+        storedRecord.pop("_id", None)
+        relativeUrl = record["relativeUrl"]
+        if "://" in relativeUrl:
+            # strip the scheme and host of absolute urls
+            relativeUrl = relativeUrl.split("://", 1)[1].partition("/")[2]
+        storedRecord["relativeUrl"] = relativeUrl
+        if not os.path.isfile(self._packageStore.getFilePath(relativeUrl)):
+            self._packageStore.addFile(relativeUrl, archivePath)
+        self._packageStore.addRecordIfMissing("packages", packageName, storedRecord)
 
     # removes previous builds so that this build
     # is a fresh build (on this machine). This
@@ -175,22 +341,84 @@ class MetaBuild(object):
         if os.path.exists(buildDirectory):
             Utilities.rmTree(buildDirectory)
 
+    def getFingerprintPath(self, node):
+        return os.path.join(FileSystem.getDirectory(FileSystem.WORKING, self._config, node._name), "fingerprint")
+
+    def readFingerprint(self, node):
+        fingerprintPath = self.getFingerprintPath(node)
+        if not os.path.exists(fingerprintPath):
+            return None
+        with open(fingerprintPath, "r") as f:
+            return f.read().strip()
+
+    def writeFingerprint(self, node, fingerprint):
+        Utilities.mkdir(os.path.dirname(self.getFingerprintPath(node)))
+        with open(self.getFingerprintPath(node), "w") as f:
+            f.write(fingerprint + "\n")
+
+    # computes a hash of everything that goes into building a package: its source tree
+    # (including package.xml), the CMake args and generator, the build steps that are run, the
+    # format of its archive and the fingerprints of everything it depends on. Because the
+    # fingerprints of dependencies are included, a package that is rebuilt forces everything that
+    # depends on it to be rebuilt as well.
+    #
+    # a portable fingerprint (see getBuildCacheKey) is the same for every checkout of the same
+    # sources: it leaves out the build number, the location of the project and the format of the
+    # archive (which is made after the cached build steps). It is None if the portable
+    # fingerprint of a local dependency is not known (it was not built by this build).
+    def computeFingerprint(self, node, buildSteps, portable=False):
+        fingerprintKey = (self._config, node._name, "portable") if portable else (self._config, node._name)
+        packageMainPath = node._extraInfo["packageMainPath"]
+        fingerprint = hashlib.sha1()
+        if not portable:
+            fingerprint.update("build:%s\n" % self._project_build_number)
+            # the archive that package() makes (the build cache only holds the output of the build)
+            fingerprint.update("archive:%s:%s\n" % (self._packageFormat, "deterministic" in self._custom_args))
+        fingerprint.update("generator:%s\n" % self._custom_args.get("generator", "make").lower())
+        fingerprint.update("sources:%s\n" % Utilities.hashTree(packageMainPath))
+        fingerprint.update("package.xml:%s\n" % Utilities.hashFile(os.path.join(packageMainPath, "package.xml")))
+        wd = FileSystem.getDirectory(FileSystem.WORKING, self._config, node._name)
+        CMakeArgs = self.getCMakeArgs(node, "", wd, self._custom_args.get("test", "OFF"),
+                                      self._custom_args.get("logging", "OFF"),
+                                      self._custom_args.get("python", "OFF"))
+        if portable:
+            rootDir = FileSystem.getDirectory(FileSystem.ROOT)
+            CMakeArgs = [arg.replace(rootDir, "<root>").replace(rootDir.replace("\\", "/"), "<root>")
+                         for arg in CMakeArgs]
+        fingerprint.update("cmake:%s\n" % "\n".join(CMakeArgs))
+        fingerprint.update("steps:%s\n" % ",".join([buildStep.__name__ for buildStep in buildSteps]))
+        for dependency in sorted(set(node._outgoingEdges) | set(node._extraInfo.get("externalDeps", []))):
+            if dependency in self._aggregatedGlobalDeps:
+                # external packages are identified by the version that was downloaded
+                depFingerprint = self._aggregatedGlobalDeps[dependency]
+            elif portable:
+                # only known if the dependency was built by this build
+                depFingerprint = self._fingerprints.get((self._config, dependency, "portable"))
+                if depFingerprint is None:
+                    self._fingerprints[fingerprintKey] = None
+                    return None
+            elif (self._config, dependency) in self._fingerprints:
+                depFingerprint = self._fingerprints[(self._config, dependency)]
+            else:
+                depFingerprint = self.readFingerprint(self._buildGraph.GetNode(dependency))
+            fingerprint.update("dependency:%s:%s\n" % (dependency, depFingerprint))
+
+        self._fingerprints[fingerprintKey] = fingerprint.hexdigest()
+        return self._fingerprints[fingerprintKey]
+
     def findDependencyVersions(self, requiredProjects):
         projectRecords = []
         buildDepPath = FileSystem.getDirectory(FileSystem.BUILD_DEPENDENCIES, self._config, self._project_name)
-        for project in requiredProjects:
-            # self._dbManager.openCollection(project[0])
-
-            def hook(records):
-                return sorted(records, key=lambda record: int(record["build_num"]))
-
-            # find correct configuration and version
-            dbParams = {
-                "config": self._config.lower(),
-                "OS": platform.system().lower(),
-            }
-            mostRecentVersion = self._httpRequest.query("packages", project[0], dbParams=dbParams,
-                                                        keysToKeep=["build_num"], hook=hook)[-1]
+        # find correct configuration and version
+        dbParams = {
+            "config": self._config.lower(),
+            "OS": platform.system().lower(),
+        }
+        mostRecentVersions = self._httpRequest.resolveLatest("packages",
+                                                             [[project[0], dbParams] for project in requiredProjects])
+        for project, mostRecentVersion in zip(requiredProjects, mostRecentVersions):
+            if mostRecentVersion is None:
+                Utilities.failExecution("No %s build of package [%s] found" % (dbParams["config"], project[0]))
             if not os.path.exists(os.path.join(buildDepPath, mostRecentVersion["fileName"])):
                 projectRecords.append([project[0], mostRecentVersion])
         return projectRecords
@@ -215,49 +443,51 @@ class MetaBuild(object):
 
         # copy packages that have already been built locally
         for package in node._outgoingEdges:
+            if package in node._extraInfo["externalDeps"]:
+                continue
             # this name is wacky. It refers to the directory where a package that this package is dependent
-            # on stored its .tar.gz file (also called a "package")
+            # on stored its archive (also called a "package")
             depPackagePackageDir = FileSystem.getDirectory(FileSystem.PACKAGE, self._config, package)
             packagePackageName = package + "_" + self._project_build_number + "_" +\
-                self._config.lower() + "_" + platform.system.lower()
-
-            # standardize the process...copy the .tar.gz file, extract, and copy results
-            Utilities.copyTree(os.path.join(depPackagePackageDir,
-                                            packagePackageName + ".tar.gz"), buildDepPath)
-            with tarfile.open(os.path.join(depPackagePackageDir,
-                                           packagePackageName + ".tar.gz"), "r:gz") as tarFile:
-                tarFile.extractall(buildDepPath)
-
-            # copy to appropriate directories
-            Utilities.copyTree(os.path.join(buildDepPath, packagePackageName, "include", package),
-                               os.path.join(outIncludeDir, package))
+                self._config.lower() + "_" + platform.system().lower()
 
-            if platform.system() == "Windows":
-                Utilities.copyTree(os.path.join(buildDepPath, packagePackageName, "bin"), binDir)
-            Utilities.copyTree(os.path.join(buildDepPath, packagePackageName, "lib"), libDir)
-            Utilities.copyTree(os.path.join(buildDepPath, packagePackageName, "cmake"),
-                               os.path.join(FileSystem.getDirectory(FileSystem.WORKING), "cmake"))
+            # standardize the process...extract the archive and copy results. Archives are
+            # extracted once and shared (see ExtractionCache): only ever copy out of them.
+            extractedPackagePath = os.path.join(
+                self._extractionCache.extract(os.path.join(depPackagePackageDir, packagePackageName +
+                                                           Utilities.getArchiveExtension(self._packageFormat))),
+                packagePackageName)
+            self.stageDependency(package, extractedPackagePath, binDir, libDir, outIncludeDir)
 
         # copy packages that were downloaded
         for package in node._extraInfo["externalDeps"]:
             packageTarGZPath = os.path.join(globalDepsDir, self._aggregatedGlobalDeps[package])
-            extractedPackagePath = packageTarGZPath.replace(".tar.gz", "")
-            with tarfile.open(packageTarGZPath, "r:gz") as tarFile:
-                tarFile.extractall(globalDepsDir)
-            # copy directories
-            # copy to appropriate directories
-            Utilities.copyTree(os.path.join(extractedPackagePath, "include", package),
-                               os.path.join(outIncludeDir, package))
-
-            if platform.system() == "Windows":
-                Utilities.copyTree(os.path.join(extractedPackagePath, "bin"), binDir)
-            Utilities.copyTree(os.path.join(extractedPackagePath, "lib"), libDir)
+            extractedPackagePath = os.path.join(self._extractionCache.extract(packageTarGZPath),
+                                                Utilities.stripArchiveExtension(os.path.basename(packageTarGZPath)))
+            self.stageDependency(package, extractedPackagePath, binDir, libDir, outIncludeDir)
+
+    # copies (or links, see -staging) the directories of an extracted package into the
+    # directories that a package is built against.
+    def stageDependency(self, package, extractedPackagePath, binDir, libDir, outIncludeDir):
+        Utilities.stageTree(os.path.join(extractedPackagePath, "include", package),
+                            os.path.join(outIncludeDir, package), self._stagingMode)
+
+        if platform.system() == "Windows":
+            Utilities.stageTree(os.path.join(extractedPackagePath, "bin"), binDir, self._stagingMode)
+        Utilities.stageTree(os.path.join(extractedPackagePath, "lib"), libDir, self._stagingMode)
+        # other packages may be running CMake against these files: replace them whole (never link
+        # them or write through them) and only stage one package into them at a time.
+        with self._cmakeStagingLock:
             Utilities.copyTree(os.path.join(extractedPackagePath, "cmake"),
-                               os.path.join(FileSystem.getDirectory(FileSystem.WORKING), "cmake"))
+                               os.path.join(FileSystem.getDirectory(FileSystem.WORKING), "cmake"),
+                               copyFunction=Utilities.replaceFile)
 
     def defaultSetupWorkspace(self, node):
         print("Setting up workspaces for package [%s]" % node._name)
-        self.cleanBuildWorkspace(node)
+        # incremental builds keep the build tree (and CMakeCache.txt) from the last build
+        # so that only what changed is reconfigured and recompiled.
+        if "incremental" not in self._custom_args:
+            self.cleanBuildWorkspace(node)
         Utilities.mkdir(FileSystem.getDirectory(FileSystem.WORKING, self._config, node._name))
 
     def generateProjectVersion(self, node):
@@ -265,14 +495,24 @@ class MetaBuild(object):
             FileSystem.getDirectory(FileSystem.OUT_ROOT),
             'include'
         )
-        Utilities.mkdir(outIncludeDir)
-        with open(os.path.join(outIncludeDir, 'Version.hpp'), 'w') as file:
-            file.write("#pragma once\n"
-                       "#ifndef VERSION_H\n"
-                       "#define VERSION_H\n\n"
-                       "#define VERSION       " + self._project_build_number + "\n"
-                       "#define VERSION_STR  \"" + self._project_build_number + "\"\n\n"
-                       "#endif  // end of VERSION_H\n\n")
+        versionFilePath = os.path.join(outIncludeDir, 'Version.hpp')
+        versionFileContents = ("#pragma once\n"
+                               "#ifndef VERSION_H\n"
+                               "#define VERSION_H\n\n"
+                               "#define VERSION       " + self._project_build_number + "\n"
+                               "#define VERSION_STR  \"" + self._project_build_number + "\"\n\n"
+                               "#endif  // end of VERSION_H\n\n")
+
+        # Version.hpp is shared by every package. Don't rewrite it underneath
+        # a package that is compiling against it at the same time.
+        with self._outputLock:
+            Utilities.mkdir(outIncludeDir)
+            if os.path.exists(versionFilePath):
+                with open(versionFilePath, 'r') as file:
+                    if file.read() == versionFileContents:
+                        return
+            with open(versionFilePath, 'w') as file:
+                file.write(versionFileContents)
 
     def checkConfigArgsAndFormat(self, offset, configArgs):
         formattedHeader = ""
@@ -303,6 +543,16 @@ class MetaBuild(object):
             else self.customSetupWorkspace(node)
         self.generateProjectVersion(node)
 
+    # the path of the toolchain file relative to workingDirectory
+    def getToolchainFile(self, workingDirectory):
+        toolchainDir = os.path.relpath(os.path.join(FileSystem.getDirectory(FileSystem.WORKING),
+                                                    "cmake", "toolchains"),
+                                       workingDirectory)
+        if platform.system() == "Windows":
+            return os.path.join(toolchainDir, "toolchain_windows_%s.cmake" % Utilities.getMachineBits())
+        else:
+            return os.path.join(toolchainDir, "toolchain_unix_%s.cmake" % Utilities.getMachineBits())
+
     def getCMakeArgs(self, node, pathPrefix, workingDirectory, test, logging, python):
         CMakeProjectDir = node._extraInfo["packageMainPath"]
         relCMakeProjectDir = os.path.relpath(CMakeProjectDir,
@@ -329,10 +579,9 @@ class MetaBuild(object):
         outIncludeDir = os.path.join(FileSystem.getDirectory(FileSystem.OUT_ROOT, self._config, node._name),
                                      "include")
 
-        toolchainDir = os.path.relpath(os.path.join(FileSystem.getDirectory(FileSystem.WORKING),
-                                                    "cmake", "toolchains"),
-                                       workingDirectory)
-        allBuiltOutDir = FileSystem.getDirectory(FileSystem.OUT_ROOT, self._config)
+        # every package is installed into its own directory: packages that build at the same
+        # time must not install into (or package) each other's files.
+        installPrefix = FileSystem.getDirectory(FileSystem.INSTALL_PREFIX, self._config, node._name)
         if platform.system() == "Windows":
             installRootDir = "\"%s\"" % installRootDir.replace("\\", "/")
             outIncludeDir = "\"%s\"" % outIncludeDir.replace("\\", "/")
@@ -343,12 +592,7 @@ class MetaBuild(object):
         else:
             cmake_config = "Debug"
 
-        fullToolchainPath = None
-        if platform.system() == "Windows":
-            fullToolchainPath = os.path.join(toolchainDir, "toolchain_windows_%s.cmake" % Utilities.getMachineBits())
-            # "x86")
-        else:
-            fullToolchainPath = os.path.join(toolchainDir, "toolchain_unix_%s.cmake" % Utilities.getMachineBits())
+        fullToolchainPath = self.getToolchainFile(workingDirectory)
 
         monoPath = os.environ.get("MONO_BASE_PATH").replace("\\", "/") \
             if os.environ.get("MONO_BASE_PATH") is not None else ""
@@ -367,7 +611,7 @@ class MetaBuild(object):
             "-DBITS=%s" % Utilities.getMachineBits(),
             "-DCMAKE_TOOLCHAIN_FILE=%s" % fullToolchainPath,  # toolchain file path (relative)
             "-DBUILD_%s=ON" % self._project_name.upper(),
-            "-DCMAKE_INSTALL_PREFIX=%s" % allBuiltOutDir,  # install root dir
+            "-DCMAKE_INSTALL_PREFIX=%s" % installPrefix,  # install root dir
             "-DENABLE_COVER=%s" % ("ON" if self._cover else "OFF"),
             "-DRUN_UNIT_TESTS=%s" % test,
             "-DENABLE_LOGGING=%s" % logging,
@@ -376,8 +620,32 @@ class MetaBuild(object):
             "-DPYTHON_VERSION=%s" % pythonVer,
             "-DPYTHON_ENABLED=%s" % python,
         ]
+        if self._compilerCache is not None:
+            CMakeArgs.extend(self._compilerCache.getCMakeArgs())
+        else:
+            # a build tree that is reused keeps its launcher in CMakeCache.txt unless it is cleared
+            CMakeArgs.extend(["-DCMAKE_C_COMPILER_LAUNCHER=", "-DCMAKE_CXX_COMPILER_LAUNCHER="])
         return CMakeArgs
 
+    # runs uploadFunction on the upload pool so that the next package builds while a package
+    # uploads. run() waits for every upload (see waitForUploads) before the build is done.
+    def startUpload(self, description, uploadFunction):
+        if self._uploadPool is None:
+            uploadFunction()
+            return
+        self._pendingUploads.append([description, self._uploadPool.submit(uploadFunction)])
+
+    # waits for every upload started by startUpload. Returns the descriptions of the failed uploads.
+    def waitForUploads(self):
+        failures = []
+        for description, uploadResult in self._pendingUploads:
+            try:
+                uploadResult.get()
+            except (Exception, SystemExit):
+                failures.append(description)
+        self._pendingUploads = []
+        return failures
+
     # this method will generate documentation
     # of the project. We are using Doxygen
     # to fulfill this.
@@ -385,7 +653,9 @@ class MetaBuild(object):
         print("generating documentation for package [%s]" % node._name)
 
     # this method will package the project into
-    # a gzipped tarball (tar.gz) file.
+    # an archive (a gzipped tarball by default, see -package_format).
+    # The files are streamed straight from where they were built into the archive.
+    # With -deterministic, the same files always make a byte for byte identical archive.
     def package(self, node):
         print("packaging package [%s]" % node._name)
         packageDir = FileSystem.getDirectory(FileSystem.PACKAGE,
@@ -395,22 +665,20 @@ class MetaBuild(object):
             "_" + self._config.lower() + "_%s" % platform.system().lower()
         if os.path.exists(packageDir):
             Utilities.rmTree(packageDir)
-        Utilities.mkdir(os.path.join(packageDir, packageFileName))
-        outRoot = FileSystem.getDirectory(FileSystem.OUT_ROOT, self._config)
-        for outDir in os.listdir(outRoot):
-            Utilities.copyTree(os.path.join(outRoot, outDir), os.path.join(packageDir, packageFileName, outDir))
-        Utilities.copyTree(FileSystem.getDirectory(FileSystem.CMAKE_BASE_DIR, projectName=node._name),
-                           os.path.join(packageDir, packageFileName, "cmake"))
-        Utilities.copyTree(os.path.join(node._extraInfo["packageMainPath"], "LICENSE"),
-                           os.path.join(packageDir, packageFileName))
-        Utilities.copyTree(os.path.join(node._extraInfo["packageMainPath"], "README.md"),
-                           os.path.join(packageDir, packageFileName))
-        Utilities.copyTree(os.path.join(node._extraInfo["packageMainPath"], "package.xml"),
-                           os.path.join(packageDir, packageFileName))
-
-        with tarfile.open(os.path.join(packageDir, packageFileName + ".tar.gz"),
-                          "w:gz") as tarFile:
-            tarFile.add(os.path.join(packageDir, packageFileName), arcname=packageFileName)
+        Utilities.mkdir(packageDir)
+        installPrefix = FileSystem.getDirectory(FileSystem.INSTALL_PREFIX, self._config, node._name)
+        archivePath = os.path.join(packageDir, packageFileName + Utilities.getArchiveExtension(self._packageFormat))
+        deterministic = "deterministic" in self._custom_args
+        with Utilities.createArchive(archivePath, self._buildJobsPerPackage, deterministic) as tarFile:
+            # package.xml goes first: readPackageFile stops reading the archive as soon as it finds it
+            for fileName in ["package.xml", "LICENSE", "README.md"]:
+                Utilities.addToArchive(tarFile, os.path.join(node._extraInfo["packageMainPath"], fileName),
+                                       packageFileName + "/" + fileName, deterministic)
+            for outDir in sorted(os.listdir(installPrefix)):
+                Utilities.addToArchive(tarFile, os.path.join(installPrefix, outDir), packageFileName + "/" + outDir,
+                                       deterministic)
+            Utilities.addToArchive(tarFile, FileSystem.getDirectory(FileSystem.CMAKE_BASE_DIR, projectName=node._name),
+                                   packageFileName + "/cmake", deterministic)
 
     def runUnitTests(self, node, iterations=1, test="OFF", mem_check="OFF"):
         print("Running unit tests for package [%s]" % node._name)
@@ -486,6 +754,182 @@ class MetaBuild(object):
         for buildStep in buildSteps:
             self.executeStep(buildStep)
 
+    # runs all build steps for a single package. This is called from the scheduler's
+    # worker threads so the configuration and custom args are set for the thread that
+    # runs this package.
+    def buildPackage(self, node, buildSteps, configuration, customArgs):
+        self._config = configuration
+        self._custom_args = dict(customArgs)
+        self._custom_args["node"] = node
+        startTime = time.time()
+        incremental = "incremental" in self._custom_args
+        if not incremental and self._buildCache is None:
+            self.executeBuildSteps(buildSteps)
+            self.recordBuildDuration(node, time.time() - startTime)
+            return
+
+        # the portable fingerprint goes into the cache keys of the packages that depend on this
+        # one, so it is needed even if this package is up to date.
+        portableFingerprint = None
+        if self._buildCache is not None:
+            portableFingerprint = self.computeFingerprint(node, buildSteps, portable=True)
+        fingerprint = self.computeFingerprint(node, buildSteps) if incremental else None
+        if incremental:
+            # incremental builds skip packages whose inputs have not changed since they were
+            # last built successfully.
+            if fingerprint == self.readFingerprint(node):
+                print("Package [%s] is up to date (%s)" % (node._name, self._config))
+                return
+            if os.path.exists(self.getFingerprintPath(node)):
+                Utilities.rmTree(self.getFingerprintPath(node))
+        cacheHit = False
+        if self._buildCache is not None and\
+                len([buildStep for buildStep in buildSteps if buildStep.__name__ in self._cacheable_build_steps]) > 0:
+            cacheKey = self.getBuildCacheKey(node, portableFingerprint) if portableFingerprint is not None else None
+            cacheHit = self.executeCacheableBuildSteps(node, buildSteps, cacheKey)
+        else:
+            self.executeBuildSteps(buildSteps)
+        if incremental:
+            self.writeFingerprint(node, fingerprint)
+        if not cacheHit:
+            # a package that was fetched from the build cache says nothing about how long it takes to build
+            self.recordBuildDuration(node, time.time() - startTime)
+
+    # the key that the output of a package is stored under in the build cache. On top of the
+    # portable fingerprint (sources, CMake args and dependencies, see computeFingerprint) it
+    # covers everything that makes the output of one machine unusable on another. It does not
+    # depend on where the project is checked out or on the build number, so every agent that
+    # builds the same sources shares the same entries.
+    def getBuildCacheKey(self, node, fingerprint):
+        wd = FileSystem.getDirectory(FileSystem.WORKING, self._config, node._name)
+        toolchainPath = os.path.join(wd, self.getToolchainFile(wd))
+        cacheKey = hashlib.sha1()
+        cacheKey.update("fingerprint:%s\n" % fingerprint)
+        toolchainHash = Utilities.hashFile(toolchainPath) if os.path.isfile(toolchainPath) else "missing"
+        cacheKey.update("toolchain:%s\n" % toolchainHash)
+        cacheKey.update("platform:%s:%s:%s\n" % (platform.system(), platform.machine(), Utilities.getMachineBits()))
+        cacheKey.update("package:%s:%s\n" % (node._name, self._config))
+        return cacheKey.hexdigest()
+
+    # runs buildSteps, except that the cacheable steps (see _cacheable_build_steps) are skipped
+    # if the output of the package can be fetched from the build cache. If it cannot, the
+    # output is stored in the build cache once the last cacheable step is done. Returns True if
+    # the output was fetched from the build cache. The output is
+    # the OUT_ROOT of the package, which holds its build results and its install prefix (so
+    # that package() finds the installed files of a cached build). Without a cacheKey (see
+    # computeFingerprint) the package is a miss and its output is not stored.
+    def executeCacheableBuildSteps(self, node, buildSteps, cacheKey):
+        outRoot = FileSystem.getDirectory(FileSystem.OUT_ROOT, self._config, node._name)
+        lastCacheableStep = max([index for index, buildStep in enumerate(buildSteps)
+                                 if buildStep.__name__ in self._cacheable_build_steps])
+        cacheHit = None
+        for index, buildStep in enumerate(buildSteps):
+            if buildStep.__name__ in self._cacheable_build_steps:
+                # the cache is only asked once the steps before (like cleaning the workspace) are done
+                if cacheHit is None and cacheKey is None:
+                    self._buildCache.addMiss()
+                    cacheHit = False
+                elif cacheHit is None:
+                    cacheHit = self._buildCache.fetch(node._name, cacheKey, outRoot)
+                    if cacheHit:
+                        print("Using cached build of package [%s] (%s)" % (node._name, self._config))
+                if cacheHit:
+                    print("-Skipping build step [%s] (cached)" % buildStep.__name__)
+                    continue
+            self.executeStep(buildStep)
+            if index == lastCacheableStep and cacheKey is not None and not self._buildCache.isReadOnly():
+                self.startUpload("build cache of %s (%s)" % (node._name, self._config),
+                                 self._buildCache.store(node._name, cacheKey, outRoot))
+        return cacheHit
+
+    def loadBuildDurations(self):
+        durationsPath = FileSystem.getDirectory(FileSystem.BUILD_DURATIONS)
+        if os.path.exists(durationsPath):
+            try:
+                with open(durationsPath, "r") as f:
+                    self._buildDurations = json.load(f)
+            except ValueError:
+                self._buildDurations = {}
+
+    def saveBuildDurations(self):
+        durationsPath = FileSystem.getDirectory(FileSystem.BUILD_DURATIONS)
+        Utilities.mkdir(os.path.dirname(durationsPath))
+        with self._buildDurationsLock:
+            with Utilities.atomicWrite(durationsPath) as tmpDurationsPath, open(tmpDurationsPath, "w") as f:
+                json.dump(self._buildDurations, f, indent=4, sort_keys=True)
+
+    # packages that were skipped (up to date) or fetched from the build cache are not recorded:
+    # they say nothing about how long the package takes to build. The recorded time follows new
+    # builds with some damping so that one slow build (a busy machine) does not turn the schedule around.
+    def recordBuildDuration(self, node, seconds):
+        with self._buildDurationsLock:
+            durations = self._buildDurations.setdefault(self._config, {})
+            if node._name in durations:
+                seconds = (durations[node._name] + seconds) / 2.0
+            durations[node._name] = round(seconds, 3)
+
+    # the time that building each package in buildOrder is expected to take. Packages that were
+    # never built are expected to take as long as the average package.
+    def getPackageCosts(self, configuration, buildOrder):
+        with self._buildDurationsLock:
+            durations = dict(self._buildDurations.get(configuration, {}))
+        knownDurations = [durations[node._name] for node in buildOrder if node._name in durations]
+        defaultDuration = sum(knownDurations) / len(knownDurations) if len(knownDurations) > 0 else 1.0
+        return {node._name: durations.get(node._name, defaultDuration) for node in buildOrder}
+
+    # prints the chain of packages that bounds how fast a configuration can be built and how long
+    # the build takes at best with numJobs packages building at the same time.
+    def printCriticalPath(self, configuration, buildOrder, numJobs):
+        if len(buildOrder) == 0:
+            return
+        if len(self._buildDurations.get(configuration, {})) == 0:
+            print("No build times recorded for configuration [%s] yet. Packages on the longest chain start first"
+                  % configuration)
+            return
+        costs = self.getPackageCosts(configuration, buildOrder)
+        pathCosts, criticalPath = self._buildGraph.CriticalPath(buildOrder, costs)
+        totalCost = sum(costs.values())
+        pathDescription = " -> ".join(["%s (%.1fs)" % (name, costs[name]) for name in criticalPath])
+        print("Critical path (%s): %s" % (configuration, pathDescription))
+        print("Minimum build time (%s): %.1fs (critical path %.1fs, %.1fs of work on %s jobs)" %
+              (configuration, max(pathCosts[criticalPath[0]], totalCost / numJobs),
+               pathCosts[criticalPath[0]], totalCost, numJobs))
+
+    # builds all packages in buildOrder for a configuration. Packages are started as soon
+    # as all of their dependencies have been built, with at most "-jobs" packages building
+    # at the same time. Of the packages that can start, the ones on the most expensive chain of
+    # packages (by their recorded build times) start first. If a package fails, no new packages
+    # are started. Returns a list of [configuration, packageName] pairs for every package that failed.
+    def buildConfiguration(self, configuration, buildOrder, buildSteps, numJobs, customArgs):
+        print("\nbuilding configuration [%s]\n" % configuration)
+        self._config = configuration
+        pathCosts = self._buildGraph.CriticalPath(buildOrder, self.getPackageCosts(configuration, buildOrder))[0]
+        failures = Scheduler.Scheduler(self._buildGraph, numJobs, pathCosts).run(
+            buildOrder, lambda node: self.buildPackage(node, buildSteps, configuration, customArgs))
+        return [[configuration, failure[0]] for failure in failures]
+
+    # builds every configuration at the same time. Every configuration has its own
+    # directory trees so the only state that has to be kept apart is the per thread
+    # configuration and custom args.
+    def buildConfigurationsConcurrently(self, configurations, buildOrder, buildSteps, numJobs, customArgs):
+        failures = []
+
+        def buildOneConfiguration(configuration):
+            try:
+                failures.extend(self.buildConfiguration(configuration, buildOrder, buildSteps,
+                                                        numJobs, customArgs))
+            except BaseException:
+                failures.append([configuration, "<all>"])
+                raise
+
+        configurationThreads = [threading.Thread(target=buildOneConfiguration, args=(configuration,))
+                                for configuration in configurations]
+        for configurationThread in configurationThreads:
+            configurationThread.start()
+        for configurationThread in configurationThreads:
+            configurationThread.join()
+        return failures
+
     # entry point into the build process. At this point, user supplied
     # methods and arguments will have been entered and parsed. If no methods
     # are present, then the default build steps will be run.
@@ -505,19 +949,106 @@ class MetaBuild(object):
             config = self._custom_args["configuration"].lower()
             if config != "release" and config != "debug":
                 Utilities.failExecution("Unknown configuration [%s]" % config)
+        numJobs = 1
+        if "jobs" in self._custom_args:
+            try:
+                numJobs = int(self._custom_args["jobs"])
+            except ValueError:
+                numJobs = 0
+            if numJobs < 1:
+                Utilities.failExecution("Invalid number of jobs [%s]" % self._custom_args["jobs"])
+        buildJobs = multiprocessing.cpu_count()
+        if "build_jobs" in self._custom_args:
+            try:
+                buildJobs = int(self._custom_args["build_jobs"])
+            except ValueError:
+                buildJobs = 0
+            if buildJobs < 1:
+                Utilities.failExecution("Invalid number of build jobs [%s]" % self._custom_args["build_jobs"])
+        if "load_average" in self._custom_args:
+            try:
+                self._loadAverage = float(self._custom_args["load_average"])
+            except ValueError:
+                Utilities.failExecution("Invalid load average [%s]" % self._custom_args["load_average"])
 
         # if the user has not specified any build steps, run the default
         if len(buildSteps) == 0:
             buildSteps = self._build_steps
 
-        self._packages_to_build = self.findProjectsInWorkspace()
+        artifactCacheSize = 10 * 1024
+        if "artifact_cache_size" in self._custom_args:
+            try:
+                artifactCacheSize = int(self._custom_args["artifact_cache_size"])
+            except ValueError:
+                Utilities.failExecution("Invalid artifact cache size [%s]" % self._custom_args["artifact_cache_size"])
+        self._artifactCache = ArtifactCache.ArtifactCache(FileSystem.getDirectory(FileSystem.ARTIFACT_CACHE),
+                                                          artifactCacheSize * 1024 * 1024)
+        self._extractionCache = ExtractionCache.ExtractionCache(
+            FileSystem.getDirectory(FileSystem.EXTRACTED_DEPENDENCIES))
+        if "package_format" in self._custom_args:
+            self._packageFormat = self._custom_args["package_format"]
+            if self._packageFormat not in Utilities.ARCHIVE_FORMATS:
+                Utilities.failExecution("Unknown package format [%s]" % self._packageFormat)
+        if "staging" in self._custom_args:
+            self._stagingMode = self._custom_args["staging"]
+            if self._stagingMode not in Utilities.STAGING_MODES:
+                Utilities.failExecution("Unknown staging mode [%s]" % self._stagingMode)
+        if "compiler_launcher" in self._custom_args:
+            compilerCacheSize = 5 * 1024
+            if "compiler_cache_size" in self._custom_args:
+                try:
+                    compilerCacheSize = int(self._custom_args["compiler_cache_size"])
+                except ValueError:
+                    Utilities.failExecution("Invalid compiler cache size [%s]" %
+                                            self._custom_args["compiler_cache_size"])
+            launcher = self._custom_args["compiler_launcher"]
+            self._compilerCache = CompilerCache.CompilerCache("ccache" if launcher is True else launcher,
+                                                              FileSystem.getDirectory(FileSystem.COMPILER_CACHE),
+                                                              compilerCacheSize,
+                                                              FileSystem.getDirectory(FileSystem.ROOT))
+            # every compiler that the build starts inherits the environment of this process
+            os.environ.update(self._compilerCache.getEnvironment())
+            self._compilerCache.start()
+        if "download_jobs" in self._custom_args:
+            try:
+                self._downloadJobs = int(self._custom_args["download_jobs"])
+            except ValueError:
+                self._downloadJobs = 0
+            if self._downloadJobs < 1:
+                Utilities.failExecution("Invalid number of download jobs [%s]" % self._custom_args["download_jobs"])
+        metadataTTL = 300
+        if "metadata_ttl" in self._custom_args:
+            try:
+                metadataTTL = int(self._custom_args["metadata_ttl"])
+            except ValueError:
+                Utilities.failExecution("Invalid metadata ttl [%s]" % self._custom_args["metadata_ttl"])
+        buildCacheMode = self._custom_args.get("build_cache")
+        if buildCacheMode not in [None, True, "read"]:
+            Utilities.failExecution("Unknown build cache mode [%s]" % buildCacheMode)
+        packageStoreDir = FileSystem.getDirectory(FileSystem.PACKAGE_STORE)
+        if "package_store" in self._custom_args:
+            packageStoreDir = os.path.abspath(self._custom_args["package_store"])
+        if "offline" in self._custom_args:
+            print("Building offline from the package store at %s" % packageStoreDir)
+            self._httpRequest = PackageStoreRequest.PackageStoreRequest(packageStoreDir)
+        elif self._httpRequest is None:
+            Utilities.failExecution("FILESERVER_URI env var not set. Cannot download dependencies " +
+                                    "(use -offline to build from the local package store)")
+        else:
+            self._httpRequest.setMaxConnections(self._downloadJobs)
+            self._httpRequest.metadataCache = MetadataCache.MetadataCache(
+                FileSystem.getDirectory(FileSystem.METADATA_CACHE), metadataTTL)
+            if "seed_package_store" in self._custom_args:
+                self._packageStore = PackageStore.PackageStore(packageStoreDir)
+        if buildCacheMode is not None:
+            self._buildCache = BuildCache.BuildCache(self._httpRequest, readOnly=buildCacheMode == "read")
+
+        self._packages_to_build = self.selectPackagesToBuild(self.findProjectsInWorkspace())
         self.createGraph()
         print("+-------------------------------------+")
         print("|  Downloading all external packages  |")
         print("+-------------------------------------+")
         self.loadGlobalPackageDependencies()
-        while(self.continueLoadingDependencies()):
-            self.loadGlobalPackageDependencies()
 
         buildOrder = self._buildGraph.TopologicalSort()
         maxPackageLenth = len("---------------------------------------")
@@ -534,19 +1065,49 @@ class MetaBuild(object):
         # run the build for the user specified configuration else run for
         # all configurations (the user can restrict this to build for
         # debug or release versions)
-        if config is not None:
-            self._config = config
-            print("\nbuilding configuration [%s]\n" % self._config)
-            for packageToBuild in buildOrder:
-                self._custom_args["node"] = packageToBuild
-                self.executeBuildSteps(buildSteps)
+        configurations = [config] if config is not None else self._configurations
+        failures = []
+        self.loadBuildDurations()
+        for configuration in configurations:
+            self.printCriticalPath(configuration, buildOrder, numJobs)
+
+        # the compiler processes of every package that is building share one budget of
+        # "-build_jobs" processes. Where a jobserver is available the native build tools
+        # hand out the jobs between them, otherwise every package gets an equal share.
+        numConcurrentPackages = numJobs
+        if "parallel_configurations" in self._custom_args:
+            numConcurrentPackages *= len(configurations)
+        self._buildJobsPerPackage = max(1, buildJobs // numConcurrentPackages)
+        if JobServer.isSupported():
+            self._jobServer = JobServer.JobServer(buildJobs)
+        self._uploadPool = Utilities.WorkerPool(self._downloadJobs)
+        if "parallel_configurations" in self._custom_args and len(configurations) > 1:
+            failures = self.buildConfigurationsConcurrently(configurations, buildOrder, buildSteps,
+                                                            numJobs, self._custom_args)
         else:
-            for configuration in self._configurations:
-                print("\nbuilding configuration [%s]\n" % configuration)
-                self._config = configuration
-                for packageToBuild in buildOrder:
-                    self._custom_args["node"] = packageToBuild
-                    self.executeBuildSteps(buildSteps)
+            for configuration in configurations:
+                failures = self.buildConfiguration(configuration, buildOrder, buildSteps,
+                                                   numJobs, self._custom_args)
+                if len(failures) > 0:
+                    break
+        if self._jobServer is not None:
+            self._jobServer.close()
+            self._jobServer = None
+        self.saveBuildDurations()
+        if len(self._pendingUploads) > 0:
+            print("Waiting for %s uploads to finish" % len(self._pendingUploads))
+        uploadFailures = self.waitForUploads()
+        self._uploadPool.close()
+        self._uploadPool = None
+        if self._buildCache is not None:
+            self._buildCache.printStatistics()
+        if self._compilerCache is not None:
+            self._compilerCache.printStatistics()
+        if len(failures) > 0:
+            Utilities.failExecution("Packages failed to build: %s" %
+                                    ", ".join(["%s (%s)" % (name, configuration) for configuration, name in failures]))
+        if len(uploadFailures) > 0:
+            Utilities.failExecution("Uploads failed: %s" % ", ".join(uploadFailures))
 
         print("+---------------------+")
         print("|   BUILD SUCCESSFUL  |")
@@ -564,6 +1125,47 @@ class MetaBuild(object):
         print("         -configuration <project>    the configuration of the build (debug or release).")
         print("         -projects  <projects...>    the projects that will be built and the order in which")
         print("                                     they are built.")
+        print("         -jobs <num>                 the number of packages that are built at the same time")
+        print("                                     (default = 1).")
+        print("         -incremental                skips packages whose sources, CMake args and dependencies")
+        print("                                     have not changed since their last successful build and")
+        print("                                     keeps the build trees of the packages that are rebuilt.")
+        print("         -build_jobs <num>           the total number of compiler processes shared by all packages")
+        print("                                     that are building (default = number of CPUs).")
+        print("         -load_average <num>         do not start new compiler processes while the load average")
+        print("                                     is above this value.")
+        print("         -download_jobs <num>        the number of packages that are downloaded at the same time")
+        print("                                     (default = 8).")
+        print("         -artifact_cache_size <MB>   the size of the downloaded package cache (default = 10240).")
+        print("                                     The cache is kept in RBUILD_CACHE_DIR (default = ~/.rbuild).")
+        print("         -metadata_ttl <seconds>     how long answers to package queries are reused before they")
+        print("                                     are checked with the server again (default = 300).")
+        print("         -offline                    resolves and downloads packages from the local package store")
+        print("                                     instead of the package server (FILESERVER_URI).")
+        print("         -seed_package_store         puts every package that this build resolves in the local")
+        print("                                     package store so that later builds can run -offline.")
+        print("         -package_store <dir>        the local package store (default = RBUILD_CACHE_DIR/store).")
+        print("         -staging <mode>             how dependencies are put in the directories that packages are")
+        print("                                     built against: copy, hardlink, symlink or reflink (copy on")
+        print("                                     write). Linking is near instant and uses no extra space, and")
+        print("                                     falls back to copying where it is not possible (default = copy).")
+        print("         -package_format <format>    the archive format of packages: tar.gz, tar.zst or tar")
+        print("                                     (default = tar.gz). Archives are compressed on several")
+        print("                                     threads when pigz (tar.gz) or zstd (tar.zst) is installed.")
+        print("         -deterministic              packages the same files into byte for byte identical archives")
+        print("                                     (sorted entries, no owners, fixed times and permissions).")
+        print("         -build_cache[=read]         downloads the output of packages that were already built from")
+        print("                                     the same inputs (on any machine) instead of building them,")
+        print("                                     and uploads the output of the packages that are built")
+        print("                                     (unless =read). Works with -offline (local package store).")
+        print("         -compiler_launcher=<name>   compiles through a compiler cache: ccache (the default) or")
+        print("                                     sccache. The cache is kept in build/compilerCache.")
+        print("         -compiler_cache_size <MB>   the size of the compiler cache (default = 5120).")
+        print("         -packages=<a,b>             only builds these packages and the packages that they depend on.")
+        print("         -affected_by=<a,b>          only builds the packages that depend on these packages (after a")
+        print("                                     change to them) and the packages that those depend on.")
+        print("         -parallel_configurations    builds all configurations at the same time instead of one")
+        print("                                     after another (each configuration uses -jobs workers).")
         print("         -iterations <num>           the number of times that unit tests will be run as part")
         print("                                     or the build process.")
         print("         -logging <ON|OFF>           enables or disables logging capabilites (default = OFF).")
@@ -0,0 +1,107 @@
+# SYSTEM IMPORTS
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+if sys.version_info[0] < 3:
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
+# PYTHON PROJECT IMPORTS
+import Utilities
+
+
+# "HTTP://Host:80/" and "http://host" are the same server
+def normalizeUrl(url):
+    parsedUrl = urlparse(url.strip())
+    scheme = parsedUrl.scheme.lower()
+    netloc = parsedUrl.netloc.lower()
+    if (scheme, parsedUrl.port) in [("http", 80), ("https", 443)]:
+        netloc = netloc.rsplit(":", 1)[0]
+    return "%s://%s%s" % (scheme, netloc, parsedUrl.path.rstrip("/"))
+
+
+# the cache directory is shared by every server that is used, so the server is part of the key
+def makeKey(baseUrl, requestName, dbName, collectionName, dbParams):
+    keyData = json.dumps([normalizeUrl(baseUrl), requestName, dbName, collectionName, dbParams], sort_keys=True)
+    return hashlib.sha1(keyData.encode("utf-8")).hexdigest()
+
+
+# caches the records that the package server answers queries with.
+#
+# Answers are memoized for the lifetime of the process, so every distinct question is asked at
+# most once per build. They are also written to disk together with the ETag/Last-Modified of the
+# answer. An answer on disk that is younger than ttlSeconds is used as is. An older answer is
+# revalidated with a conditional request, which is cheap when nothing changed (304). If the server
+# cannot be reached, the answer on disk is used no matter how old it is.
+#
+# layout:
+#   <cacheDir>/<key[:2]>/<key>.json         {records, etag, lastModified, fetched}
+class MetadataCache(object):
+    def __init__(self, cacheDir, ttlSeconds):
+        self._cacheDir = cacheDir
+        self._ttlSeconds = ttlSeconds
+        self._memory = {}
+        self._keyLocks = {}
+        self._lock = threading.Lock()
+
+    def getEntryPath(self, key):
+        return os.path.join(self._cacheDir, key[:2], key + ".json")
+
+    # a lock per key so that threads asking the same question wait for one answer
+    # instead of all asking the server.
+    def getKeyLock(self, key):
+        with self._lock:
+            if key not in self._keyLocks:
+                self._keyLocks[key] = threading.Lock()
+            return self._keyLocks[key]
+
+    # returns the answer that was already given during this build (or None)
+    def getMemoized(self, key):
+        with self._lock:
+            return self._memory.get(key)
+
+    # returns the answer stored on disk (or None)
+    def load(self, key):
+        entryPath = self.getEntryPath(key)
+        if not os.path.exists(entryPath):
+            return None
+        try:
+            with open(entryPath, "r") as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def isFresh(self, entry):
+        return time.time() - entry["fetched"] < self._ttlSeconds
+
+    def memoize(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+
+    def store(self, key, records, etag=None, lastModified=None):
+        entry = {
+            "records": records,
+            "etag": etag,
+            "lastModified": lastModified,
+            "fetched": time.time(),
+        }
+        self.save(key, entry)
+        return entry
+
+    # marks an answer on disk as just revalidated
+    def touch(self, key, entry):
+        entry["fetched"] = time.time()
+        self.save(key, entry)
+        return entry
+
+    def save(self, key, entry):
+        self.memoize(key, entry)
+        entryPath = self.getEntryPath(key)
+        Utilities.mkdir(os.path.dirname(entryPath))
+        with Utilities.atomicWrite(entryPath) as tmpEntryPath, open(tmpEntryPath, "w") as f:
+            json.dump(entry, f)
@@ -0,0 +1,79 @@
+# SYSTEM IMPORTS
+import json
+import os
+import shutil
+import threading
+
+# PYTHON PROJECT IMPORTS
+import Utilities
+
+
+# a package database and file store kept in a directory. It stores the same records that
+# the package server does, and is used to stand in for the server (see LocalPackageServer).
+#
+# layout:
+#   <rootDir>/db/<dbName>/<collectionName>.json     list of records
+#   <rootDir>/files/<relativeUrl>                   the files that records point to
+class PackageStore(object):
+    def __init__(self, rootDir):
+        self._rootDir = os.path.abspath(rootDir)
+        self._lock = threading.Lock()
+
+    def getCollectionPath(self, dbName, collectionName):
+        return os.path.join(self._rootDir, "db", dbName, collectionName + ".json")
+
+    def getFilePath(self, relativeUrl):
+        filesDir = os.path.join(self._rootDir, "files")
+        filePath = os.path.abspath(os.path.join(filesDir, relativeUrl.lstrip("/")))
+        if filePath != filesDir and not filePath.startswith(filesDir + os.sep):
+            Utilities.failExecution("Url [%s] is outside of the package store" % relativeUrl)
+        return filePath
+
+    def loadCollection(self, dbName, collectionName):
+        collectionPath = self.getCollectionPath(dbName, collectionName)
+        if not os.path.exists(collectionPath):
+            return []
+        with open(collectionPath, "r") as f:
+            return json.load(f)
+
+    def saveCollection(self, dbName, collectionName, records):
+        collectionPath = self.getCollectionPath(dbName, collectionName)
+        Utilities.mkdir(os.path.dirname(collectionPath))
+        with Utilities.atomicWrite(collectionPath) as tmpCollectionPath, open(tmpCollectionPath, "w") as f:
+            json.dump(records, f, indent=1, sort_keys=True)
+
+    # returns every record whose values match params. Values are compared as strings
+    # because query parameters arrive as strings.
+    def query(self, dbName, collectionName, params={}):
+        with self._lock:
+            records = self.loadCollection(dbName, collectionName)
+        return [record for record in records
+                if all([str(record.get(key)) == str(value) for key, value in params.items()])]
+
+    # returns the matching record with the highest sortKey (or None)
+    def resolveLatest(self, dbName, collectionName, params={}, sortKey="build_num"):
+        records = [record for record in self.query(dbName, collectionName, params) if sortKey in record]
+        if len(records) == 0:
+            return None
+        return sorted(records, key=lambda record: int(record[sortKey]))[-1]
+
+    def addRecord(self, dbName, collectionName, record):
+        with self._lock:
+            records = self.loadCollection(dbName, collectionName)
+            records.append(record)
+            self.saveCollection(dbName, collectionName, records)
+
+    # adds record unless the collection already holds an identical one
+    def addRecordIfMissing(self, dbName, collectionName, record):
+        with self._lock:
+            records = self.loadCollection(dbName, collectionName)
+            if record in records:
+                return
+            records.append(record)
+            self.saveCollection(dbName, collectionName, records)
+
+    def addFile(self, relativeUrl, srcPath):
+        filePath = self.getFilePath(relativeUrl)
+        Utilities.mkdir(os.path.dirname(filePath))
+        shutil.copy2(srcPath, filePath)
+        return filePath
@@ -0,0 +1,55 @@
+# SYSTEM IMPORTS
+import os
+import shutil
+
+# PYTHON PROJECT IMPORTS
+import PackageStore
+import Utilities
+
+
+# answers the requests that a build makes of the package server (see HTTPRequest) from a
+# PackageStore on this machine instead. Used for -offline builds, which never touch the network.
+class PackageStoreRequest(object):
+    def __init__(self, storeDir):
+        self.baseUrl = storeDir
+        self.store = PackageStore.PackageStore(storeDir)
+
+    def setMaxConnections(self, maxConnections):
+        # nothing to connect to
+        pass
+
+    def query(self, dbName, collectionName, dbParams={}, keysToKeep=[], keysToIgnore=[], hook=None, cached=True):
+        # whole records are returned: keysToKeep and keysToIgnore only exist to save bandwidth
+        requestData = self.store.query(dbName, collectionName, dbParams)
+        if hook is not None:
+            requestData = hook(requestData)
+        return requestData
+
+    def resolveLatest(self, dbName, queries, sortKey="build_num"):
+        return [self.store.resolveLatest(dbName, collectionName, dbParams, sortKey)
+                for collectionName, dbParams in queries]
+
+    def download(self, receivingDirPath, dbName, collectionName, urlParams=[],
+                 dbParams={}, keysToKeep=[], keysToIgnore=[], fileChunkSize=0, readBytes=True, hook=None):
+        requestData = self.query(dbName, collectionName, dbParams=dbParams,
+                                 keysToKeep=keysToKeep, keysToIgnore=keysToIgnore, hook=hook)
+        for fileToDownload in requestData:
+            self.downloadRecord(receivingDirPath, fileToDownload)
+        return requestData
+
+    def downloadRecord(self, receivingDirPath, fileToDownload, fileChunkSize=0, readBytes=True, resume=True):
+        storedFilePath = self.store.getFilePath(fileToDownload["relativeUrl"])
+        if not os.path.isfile(storedFilePath):
+            Utilities.failExecution("%s is not in the package store at %s" %
+                                    (fileToDownload["relativeUrl"], self.baseUrl))
+        filePath = os.path.join(receivingDirPath, fileToDownload["fileName"] + fileToDownload["filetype"])
+        if os.path.exists(filePath):
+            os.remove(filePath)
+        shutil.copy2(storedFilePath, filePath)
+        print("Copied %s from the package store" % os.path.basename(filePath))
+
+    def upload(self, filePath, dbName, collectionName, fileName="", dbParams={}, urlParams=[]):
+        fullFilePath = filePath if fileName == "" else os.path.join(filePath, fileName)
+        self.store.addFile("/".join(urlParams + [os.path.basename(fullFilePath)]), fullFilePath)
+        if len(dbParams) > 0:
+            self.store.addRecord(dbName, collectionName, dbParams)
@@ -25,12 +25,51 @@ class ProjectBuild(MetaBuild):
             os.environ["BUILD_NUMBER"] if os.environ.get("BUILD_NUMBER") is not None else 0
         )
         self._installTarget = True
+        self._cacheable_build_steps = ["cmake", "make", "build"]
         # if os.environ.get("MONGODB_URI") is None:
         #     Utilities.failExecution("MONGODB_URI env var not set. Cannot download dependencies")
-        if os.environ.get("FILESERVER_URI") is None:
-            Utilities.failExecution("FILESERVER_URI env var not set. Cannot download dependencies")
+        # without FILESERVER_URI only -offline builds can run (checked in run())
         # self._dbManager = DBManager.DBManager(databaseName="packages")
-        self._httpRequest = HTTPRequest.HTTPRequest(os.environ["FILESERVER_URI"])
+        if os.environ.get("FILESERVER_URI") is not None:
+            self._httpRequest = HTTPRequest.HTTPRequest(os.environ["FILESERVER_URI"])
+
+    # the CMake generator ("make" or "ninja") selected with -generator
+    def getGenerator(self):
+        generator = self._custom_args.get("generator", "make").lower()
+        if generator not in ["make", "ninja"]:
+            Utilities.failExecution("Unknown generator [%s]" % generator)
+        return generator
+
+    # the CMake args (and toolchain file) that the build tree in wd was last configured with
+    # are stored next to CMakeCache.txt so that we know when the tree has to be reconfigured.
+    def getConfigureStamp(self, wd, CMakeArgs):
+        toolchainPath = os.path.join(wd, self.getToolchainFile(wd))
+        toolchainHash = Utilities.hashFile(toolchainPath) if os.path.isfile(toolchainPath) else "missing"
+        return "\n".join(CMakeArgs + ["toolchain:%s" % toolchainHash]) + "\n"
+
+    def configureIsUpToDate(self, wd, configureStamp):
+        configureStampPath = os.path.join(wd, "cmake_args")
+        if not os.path.exists(os.path.join(wd, "CMakeCache.txt")) or not os.path.exists(configureStampPath):
+            return False
+        with open(configureStampPath, "r") as f:
+            return f.read() == configureStamp
+
+    # CMake refuses to configure a build tree that was configured with a different generator.
+    # In that case throw away the cache (and the generated files) and configure from scratch.
+    def removeCacheForOtherGenerator(self, wd, generatorName):
+        CMakeCachePath = os.path.join(wd, "CMakeCache.txt")
+        if not os.path.exists(CMakeCachePath):
+            return
+        with open(CMakeCachePath, "r") as f:
+            for line in f:
+                if line.startswith("CMAKE_GENERATOR:INTERNAL="):
+                    if line.strip().split("=", 1)[1] == generatorName:
+                        return
+                    break
+        print("Generator changed to [%s]. Removing CMake cache in %s" % (generatorName, wd))
+        Utilities.rmTree(CMakeCachePath)
+        if os.path.exists(os.path.join(wd, "CMakeFiles")):
+            Utilities.rmTree(os.path.join(wd, "CMakeFiles"))
 
     # this method will launch CMake.
     # CMake is handling all of our compiling and linking.
@@ -40,25 +79,70 @@ class ProjectBuild(MetaBuild):
         Utilities.mkdir(wd)
 
         CMakeArgs = self.getCMakeArgs(node, "", wd, test, logging, python)
-        if platform.system() == "Windows":
+        if self.getGenerator() == "ninja":
+            CMakeArgs.extend(["-G", "Ninja"])
+        elif platform.system() == "Windows":
             CMakeArgs.extend(["-G", "\"NMake Makefiles\""])
+        else:
+            CMakeArgs.extend(["-G", "Unix Makefiles"])
+
+        # a build tree that was configured with exactly these args is reused as is.
+        # make and ninja rerun CMake by themselves if a CMakeLists.txt file changed.
+        configureStamp = self.getConfigureStamp(wd, CMakeArgs)
+        configureStampPath = os.path.join(wd, "cmake_args")
+        if self.configureIsUpToDate(wd, configureStamp):
+            print("CMake args for package [%s] have not changed. Skipping configure" % node._name)
+            return
+        if os.path.exists(configureStampPath):
+            Utilities.rmTree(configureStampPath)
+        self.removeCacheForOtherGenerator(wd, CMakeArgs[CMakeArgs.index("-G") + 1].strip("\""))
+
+        if platform.system() == "Windows":
             Utilities.PForkWithVisualStudio(appToExecute="cmake",
                                             argsForApp=CMakeArgs,
                                             wd=wd)
         else:
-            CMakeArgs.extend(["-G", "Unix Makefiles"])
             Utilities.PFork(appToExecute="cmake", argsForApp=CMakeArgs, wd=wd, failOnError=True)
+        with open(configureStampPath, "w") as f:
+            f.write(configureStamp)
 
     def makeTarget(self, node, targets):
         # make directory that CMake will dump all output to
         wd = FileSystem.getDirectory(FileSystem.WORKING, self._config, node._name)
 
-        if platform.system() == "Windows":
+        if self.getGenerator() == "ninja":
+            # ninja is not a jobserver client, so it gets its share of the job budget.
+            ninjaArgs = ["-j", str(self._buildJobsPerPackage)]
+            if self._loadAverage is not None:
+                ninjaArgs.extend(["-l", str(self._loadAverage)])
+            ninjaArgs.extend(targets)
+            if platform.system() == "Windows":
+                Utilities.PForkWithVisualStudio(appToExecute="ninja",
+                                                argsForApp=ninjaArgs,
+                                                wd=wd)
+            else:
+                Utilities.PFork(appToExecute="ninja", argsForApp=ninjaArgs, wd=wd, failOnError=True)
+        elif platform.system() == "Windows":
+            # nmake cannot build in parallel.
             Utilities.PForkWithVisualStudio(appToExecute="nmake",
                                             argsForApp=targets,
                                             wd=wd)
         else:
-            Utilities.PFork(appToExecute="make", argsForApp=targets, wd=wd, failOnError=True)
+            makeArgs = list(targets)
+            if self._loadAverage is not None:
+                makeArgs.extend(["-l", str(self._loadAverage)])
+            if self._jobServer is None:
+                makeArgs.append("-j%s" % self._buildJobsPerPackage)
+                Utilities.PFork(appToExecute="make", argsForApp=makeArgs, wd=wd, failOnError=True)
+                return
+
+            # the token that is held here is the job that make runs without asking the jobserver
+            token = self._jobServer.acquire()
+            try:
+                Utilities.PFork(appToExecute="make", argsForApp=makeArgs, wd=wd, failOnError=True,
+                                environment={"MAKEFLAGS": self._jobServer.getMakeFlags()})
+            finally:
+                self._jobServer.release(token)
 
     def makeVisualStudioProjects(self, node, test="OFF", logging="OFF"):
         wd = FileSystem.getDirectory(FileSystem.VISUAL_STUDIO_ROOT, self._config, node._name)
@@ -81,6 +165,8 @@ class ProjectBuild(MetaBuild):
         self.executeBuildSteps([self.customPreBuild if hasattr(self, "customPreBuild") else self.defaultPreBuild,
                                 self.cmake, self.make])
 
+    # uploads the package archive in the background (see startUpload). A package whose content
+    # digest (see Utilities.createArchive) is already on the server is not uploaded again.
     def uploadPackagedVersion(self, node):
         if self._project_build_number != "0.0.0.0":
             print("Uploading package [%s]" % node._name)
@@ -90,9 +176,22 @@ class ProjectBuild(MetaBuild):
             packageFileName = node._name + "_" + self._project_build_number +\
                 "_" + self._config.lower() + "_%s" % platform.system().lower()
             productNumbers = [int(x) for x in self._project_build_number.split(".")]
+            archiveExtension = Utilities.getArchiveExtension(self._packageFormat)
+            contentDigest = Utilities.readArchiveDigest(os.path.join(packageDir, packageFileName + archiveExtension))
+
+            if contentDigest is not None:
+                digestParams = {
+                    "content_digest": contentDigest,
+                    "config": self._config.lower(),
+                    "OS": platform.system().lower(),
+                }
+                # ask the server itself: a cached answer may be older than the last upload
+                if len(self._httpRequest.query("packages", node._name, dbParams=digestParams, cached=False)) > 0:
+                    print("Package [%s] has not changed since it was last uploaded. Skipping upload" % node._name)
+                    return
 
             relativeUrl = HTTPRequest.urljoin(node._name, self._config.lower(),
-                                              packageFileName + ".tar.gz")
+                                              packageFileName + archiveExtension)
             # self._dbManager.openCollection(node._name)
             # self._dbManager.insert(
             dbParams = {}
@@ -104,7 +203,7 @@ class ProjectBuild(MetaBuild):
             if len(self._httpRequest.query("packages", "available_packages", dbParams=queryParams)) > 0:
                 dbParams = {
                     "fileName": packageFileName,
-                    "filetype": ".tar.gz",
+                    "filetype": archiveExtension,
                     "major_version": productNumbers[0],
                     "minor_version": productNumbers[1],
                     "patch": productNumbers[2],
@@ -113,12 +212,19 @@ class ProjectBuild(MetaBuild):
                     "OS": platform.system().lower(),
                     "relativeUrl": relativeUrl,
                 }
-            self._httpRequest.upload(packageDir,
-                                     "packages",
-                                     node._name,
-                                     fileName=packageFileName + ".tar.gz",
-                                     dbParams=dbParams,
-                                     urlParams=[node._name, self._config.lower()])
+                if contentDigest is not None:
+                    dbParams["content_digest"] = contentDigest
+            urlParams = [node._name, self._config.lower()]
+
+            def upload():
+                self._httpRequest.upload(packageDir,
+                                         "packages",
+                                         node._name,
+                                         fileName=packageFileName + archiveExtension,
+                                         dbParams=dbParams,
+                                         urlParams=urlParams)
+                print("Uploaded package [%s]" % node._name)
+            self.startUpload("%s (%s)" % (node._name, self._config), upload)
             # self._dbManager.openCollection("available_packages")
             # packageDict = {
             #     "package_name": node._name,
@@ -137,6 +243,8 @@ class ProjectBuild(MetaBuild):
         print("         makeVisualStudioProjects    generates visual studio projects.")
         print("         uploadPackagedVersion       uploads built and tested binaries for distribution.")
         print("     [%s] specific custom variables" % self._project_name)
+        print("         -generator <make|ninja>     the build tool that CMake generates files for")
+        print("                                     (default = make).")
         print("")
 
         # call help of parent class (MetaBuild)
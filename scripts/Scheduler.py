@@ -0,0 +1,109 @@
+# SYSTEM IMPORTS
+import heapq
+import sys
+import threading
+import traceback
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+# PYTHON PROJECT IMPORTS
+
+
+# schedules the nodes of a Graph onto a pool of worker threads. A node is started as soon as
+# every node it depends on (its outgoing edges) that is also being scheduled has finished.
+# When a node fails, no new nodes are started. The nodes that are already running are allowed
+# to finish so that the build stops in a clean state.
+#
+# when more nodes are ready than there are workers, the nodes with the highest priority start
+# first (see Graph.CriticalPath), then the nodes in name order.
+class Scheduler(object):
+    def __init__(self, graph, numJobs=1, priorities=None):
+        self._graph = graph
+        self._numJobs = max(1, int(numJobs))
+        self._priorities = priorities if priorities is not None else {}
+        self._failures = []
+
+    def pushReadyNode(self, readyNodes, node):
+        heapq.heappush(readyNodes, (-self._priorities.get(node._name, 0), node._name, node))
+
+    def worker(self, workQueue, doneQueue, runNode):
+        while True:
+            node = workQueue.get()
+            if node is None:
+                return
+            try:
+                runNode(node)
+                doneQueue.put((node, None))
+            except BaseException as e:
+                # failExecution() calls sys.exit(), which raises SystemExit. Catch it here so
+                # that one failing package does not take down the rest of the scheduler.
+                traceback.print_exc(file=sys.stdout)
+                doneQueue.put((node, e))
+
+    # runs "runNode(node)" for every node in "nodes". Returns a list of [nodeName, exception]
+    # pairs for every node that failed (an empty list means that everything succeeded).
+    def run(self, nodes, runNode):
+        self._failures = []
+        nodesToRun = {node._name: node for node in nodes}
+
+        # the number of dependencies of each node that have not been built yet. Dependencies
+        # that are not being scheduled (external packages for example) are already available.
+        remainingDeps = {}
+        readyNodes = []
+        for node in nodes:
+            remainingDeps[node._name] = len([dep for dep in set(node._outgoingEdges) if dep in nodesToRun])
+            if remainingDeps[node._name] == 0:
+                self.pushReadyNode(readyNodes, node)
+
+        workQueue = queue.Queue()
+        doneQueue = queue.Queue()
+        workers = []
+        for _ in range(min(self._numJobs, max(1, len(nodes)))):
+            workerThread = threading.Thread(target=self.worker, args=(workQueue, doneQueue, runNode))
+            workerThread.daemon = True
+            workerThread.start()
+            workers.append(workerThread)
+
+        numRunning = 0
+        numFinished = 0
+        try:
+            while True:
+                # only start new work while nothing has failed.
+                while len(readyNodes) > 0 and numRunning < self._numJobs and len(self._failures) == 0:
+                    workQueue.put(heapq.heappop(readyNodes)[2])
+                    numRunning += 1
+                if numRunning == 0:
+                    break
+
+                # use a timeout so that the main thread can still be interrupted (KeyboardInterrupt)
+                try:
+                    node, error = doneQueue.get(True, 1)
+                except queue.Empty:
+                    continue
+                numRunning -= 1
+                numFinished += 1
+
+                if error is not None:
+                    print("package [%s] failed. Waiting for running packages to finish" % node._name)
+                    self._failures.append([node._name, error])
+                    continue
+
+                for dependent in node._incomingEdges:
+                    if dependent in remainingDeps:
+                        remainingDeps[dependent] -= 1
+                        if remainingDeps[dependent] == 0:
+                            self.pushReadyNode(readyNodes, nodesToRun[dependent])
+        finally:
+            for _ in workers:
+                workQueue.put(None)
+        for workerThread in workers:
+            workerThread.join()
+
+        if len(self._failures) == 0 and numFinished != len(nodes):
+            # some nodes were never ready to run which means that there is a dependency cycle.
+            unbuilt = [name for name, count in remainingDeps.items() if count > 0]
+            self._failures.append([", ".join(sorted(unbuilt)), Exception("unresolvable dependencies")])
+        return self._failures
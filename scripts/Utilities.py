@@ -1,11 +1,18 @@
 
 # SYSTEM IMPORTS
+import contextlib
+import errno
+import gzip
+import hashlib
 import inspect
+import multiprocessing.pool
 import os
 import platform
 import shutil
 import subprocess
 import sys
+import tarfile
+import threading
 import traceback
 
 if platform.system() == "Windows":
@@ -70,7 +77,12 @@ def mkdir(dir):
     # DURING a build, as all created directories will be
     # deleted at the beginning of each build.
     if not os.path.exists(dir):
-        os.makedirs(dir)
+        try:
+            os.makedirs(dir)
+        except OSError as e:
+            # another thread may have created it in the meantime
+            if e.errno != errno.EEXIST or not os.path.isdir(dir):
+                raise
 
 
 def rmTree(path):
@@ -80,19 +92,390 @@ def rmTree(path):
         os.unlink(path)  # same as os.remove(path)
 
 
-def copyTree(srcPath, destPath):
-    if os.path.isdir(srcPath):
-        if os.path.isfile(destPath):
-            failExecution("Cannot copy directory [%s]: %s is a File!" %
-                          (srcPath, destPath))
-        if not os.path.exists(destPath):
-            mkdir(destPath)
-        for item in os.listdir(srcPath):
-            s = os.path.join(srcPath, item)
-            d = os.path.join(destPath, item)
-            copyTree(s, d)
-    else:
-        shutil.copy2(srcPath, destPath)  # copy2() copies file metaData
+COPY_JOBS = 8                   # the number of files that copyTree copies at the same time
+COPY_CHUNK_SIZE = 1024 * 1024   # bytes
+PARALLEL_COPY_THRESHOLD = 32    # trees with fewer files are copied without a thread pool
+# the errors that mean the zero copy system calls cannot be used for a pair of files
+ZERO_COPY_ERRORS = [getattr(errno, name) for name in ["EXDEV", "ENOSYS", "EINVAL", "EOPNOTSUPP", "ENOTSUP"]
+                    if hasattr(errno, name)]
+
+
+# returns [name, isDir] for every entry of dirPath. Symbolic links are followed.
+def scanDir(dirPath):
+    if hasattr(os, "scandir"):
+        # scandir gets the type of most entries without a stat() per entry
+        return [[entry.name, entry.is_dir()] for entry in os.scandir(dirPath)]
+    return [[name, os.path.isdir(os.path.join(dirPath, name))] for name in os.listdir(dirPath)]
+
+
+# adds the directories and [srcPath, destPath] pairs of files under srcPath to dirs and files
+def listTree(srcPath, destPath, dirs, files):
+    dirs.append(destPath)
+    for name, isDir in scanDir(srcPath):
+        if isDir:
+            listTree(os.path.join(srcPath, name), os.path.join(destPath, name), dirs, files)
+        else:
+            files.append([os.path.join(srcPath, name), os.path.join(destPath, name)])
+
+
+# copies the contents of one open file to another. The data is copied by the kernel
+# (copy_file_range or sendfile) where possible instead of through Python.
+def copyFileContents(srcFile, destFile):
+    srcFd = srcFile.fileno()
+    destFd = destFile.fileno()
+    copiedBytes = 0
+    try:
+        if hasattr(os, "copy_file_range"):
+            while True:
+                numBytes = os.copy_file_range(srcFd, destFd, COPY_CHUNK_SIZE * 64)
+                if numBytes == 0:
+                    return
+                copiedBytes += numBytes
+        elif hasattr(os, "sendfile") and platform.system() == "Linux":
+            while True:
+                numBytes = os.sendfile(destFd, srcFd, copiedBytes, COPY_CHUNK_SIZE * 64)
+                if numBytes == 0:
+                    return
+                copiedBytes += numBytes
+    except OSError as e:
+        if copiedBytes > 0 or e.errno not in ZERO_COPY_ERRORS:
+            raise
+    shutil.copyfileobj(srcFile, destFile, COPY_CHUNK_SIZE)
+
+
+# copies a file and its metadata like shutil.copy2
+def copyFile(srcPath, destPath):
+    with open(srcPath, "rb") as srcFile, open(destPath, "wb") as destFile:
+        copyFileContents(srcFile, destFile)
+    shutil.copystat(srcPath, destPath)
+
+
+# yields a temporary path next to path to write to, which is renamed to path once the block is
+# done. A process reading path at the same time sees either the old or the new file and never
+# a partly written one. The temporary file is removed if the block fails.
+@contextlib.contextmanager
+def atomicWrite(path):
+    tmpPath = "%s.%s.%s.tmp" % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        yield tmpPath
+    except BaseException:
+        removeFile(tmpPath)
+        raise
+    if os.name != "posix" and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmpPath, path)
+
+
+# True if destPath has the same contents as srcPath. The contents are compared rather than the
+# size and modification time because files extracted from deterministic archives all have the
+# same modification time.
+def hasSameContents(srcPath, destPath):
+    if not os.path.isfile(destPath) or os.path.getsize(srcPath) != os.path.getsize(destPath):
+        return False
+    with open(srcPath, "rb") as srcFile, open(destPath, "rb") as destFile:
+        while True:
+            srcChunk = srcFile.read(COPY_CHUNK_SIZE)
+            if srcChunk != destFile.read(COPY_CHUNK_SIZE):
+                return False
+            if not srcChunk:
+                return True
+
+
+# copies srcPath over destPath with atomicWrite, unless destPath already has its contents
+def replaceFile(srcPath, destPath):
+    if hasSameContents(srcPath, destPath):
+        return
+    with atomicWrite(destPath) as tmpDestPath:
+        copyFile(srcPath, tmpDestPath)
+
+
+# copies the file or directory tree at srcPath to destPath. A file copied to an existing
+# directory is copied into it. The tree is listed first and its files are copied on a pool
+# of threads, so that the time spent waiting on the disk overlaps.
+# copyFunction(srcFilePath, destFilePath) replaces the copying of single files.
+def copyTree(srcPath, destPath, copyFunction=copyFile):
+    if not os.path.isdir(srcPath):
+        if os.path.isdir(destPath):
+            destPath = os.path.join(destPath, os.path.basename(srcPath))
+        copyFunction(srcPath, destPath)
+        return
+
+    if os.path.isfile(destPath):
+        failExecution("Cannot copy directory [%s]: %s is a File!" %
+                      (srcPath, destPath))
+    dirs = []
+    files = []
+    listTree(srcPath, destPath, dirs, files)
+    for dirPath in dirs:
+        mkdir(dirPath)
+    if len(files) < PARALLEL_COPY_THRESHOLD:
+        for srcFilePath, destFilePath in files:
+            copyFunction(srcFilePath, destFilePath)
+        return
+    copyPool = WorkerPool(min(COPY_JOBS, len(files)))
+    try:
+        copyPool.map(lambda srcAndDest: copyFunction(srcAndDest[0], srcAndDest[1]), files)
+    finally:
+        copyPool.close()
+
+
+STAGING_MODES = ["copy", "hardlink", "symlink", "reflink"]
+FICLONE = 0x40049409  # linux ioctl that shares the blocks of one file with another (copy on write)
+
+
+def removeFile(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+# makes destPath a copy on write clone of srcPath. Raises EnvironmentError if the filesystem
+# (or OS) cannot do it.
+def reflinkFile(srcPath, destPath):
+    if platform.system() != "Linux":
+        raise OSError(errno.EOPNOTSUPP, "reflinks are only supported on Linux")
+    import fcntl
+    with open(srcPath, "rb") as srcFile:
+        destFd = os.open(destPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(destFd, FICLONE, srcFile.fileno())
+        except EnvironmentError:
+            os.close(destFd)
+            removeFile(destPath)
+            raise
+        os.close(destFd)
+    shutil.copystat(srcPath, destPath)
+
+
+# puts the file at srcPath at destPath with a hardlink, symlink or reflink (see STAGING_MODES)
+# and falls back to copying where that is not possible (for example across filesystems).
+# A file staged with a link shares its contents with srcPath: it must not be written to.
+def stageFile(srcPath, destPath, mode="copy"):
+    for attempt in range(2 if mode != "copy" else 0):
+        try:
+            if mode == "hardlink":
+                os.link(srcPath, destPath)
+            elif mode == "symlink":
+                os.symlink(os.path.abspath(srcPath), destPath)
+            else:
+                reflinkFile(srcPath, destPath)
+            return
+        except (AttributeError, EnvironmentError) as e:
+            if getattr(e, "errno", None) != errno.EEXIST or attempt > 0:
+                break
+            # replace what is there rather than writing through it
+            removeFile(destPath)
+    if os.path.islink(destPath) or (os.path.exists(destPath) and os.stat(destPath).st_nlink > 1):
+        # never write through a link from an earlier staging
+        removeFile(destPath)
+    copyFile(srcPath, destPath)
+
+
+# like copyTree, but files are staged with stageFile
+def stageTree(srcPath, destPath, mode="copy"):
+    def stageOneFile(srcFilePath, destFilePath):
+        stageFile(srcFilePath, destFilePath, mode)
+    copyTree(srcPath, destPath, copyFunction=stageOneFile)
+
+
+# the hex digest of the contents of a file with any algorithm of hashlib
+def hashFile(filePath, algorithm="sha1", chunkSize=1024 * 1024):
+    fileHash = hashlib.new(algorithm)
+    with open(filePath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+# hashes the relative path and contents of every file under rootPath (in a stable order).
+# version control directories are ignored.
+def hashTree(rootPath, ignoredDirs=[".git", ".svn", ".hg"]):
+    treeHash = hashlib.sha1()
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        dirNames[:] = sorted([dirName for dirName in dirNames if dirName not in ignoredDirs])
+        for fileName in sorted(fileNames):
+            filePath = os.path.join(dirPath, fileName)
+            treeHash.update(os.path.relpath(filePath, rootPath).replace("\\", "/") + "\0")
+            if os.path.islink(filePath):
+                treeHash.update("link:" + os.readlink(filePath) + "\0")
+            elif os.path.isfile(filePath):
+                treeHash.update(hashFile(filePath) + "\0")
+    return treeHash.hexdigest()
+
+
+# the formats that packages can be archived in (see createArchive)
+ARCHIVE_FORMATS = ["tar.gz", "tar.zst", "tar"]
+
+
+def getArchiveExtension(archiveFormat):
+    return "." + archiveFormat
+
+
+def getArchiveFormat(archivePath):
+    for archiveFormat in ARCHIVE_FORMATS:
+        if archivePath.endswith(getArchiveExtension(archiveFormat)):
+            return archiveFormat
+    failExecution("Unknown archive format: %s" % archivePath)
+
+
+# returns the name of an archive without its extension (the directory that packages put their files in)
+def stripArchiveExtension(archiveName):
+    return archiveName[:-len(getArchiveExtension(getArchiveFormat(archiveName)))]
+
+
+def findExecutable(name):
+    for pathDir in os.environ.get("PATH", "").split(os.pathsep):
+        for executableName in [name, name + ".exe"]:
+            executablePath = os.path.join(pathDir, executableName)
+            if os.path.isfile(executablePath) and os.access(executablePath, os.X_OK):
+                return executablePath
+    return None
+
+
+# the command that compresses (or with -d decompresses) an archive format from stdin to stdout
+# on numThreads threads, or None if it has to be done in Python.
+def getCompressorCommand(archiveFormat, numThreads, decompress=False):
+    if archiveFormat == "tar.zst":
+        if findExecutable("zstd") is None:
+            failExecution("zstd must be installed to create or read .tar.zst archives")
+        return [findExecutable("zstd"), "-q", "-c"] + (["-d"] if decompress else ["-T%s" % numThreads])
+    elif archiveFormat == "tar.gz" and not decompress and findExecutable("pigz") is not None:
+        # -n: no file name or time in the gzip header
+        return [findExecutable("pigz"), "-c", "-n", "-p", str(numThreads)]
+    return None
+
+
+# passes on what is read from fileObj and keeps the sha256 of it
+class DigestReader(object):
+    def __init__(self, fileObj):
+        self._fileObj = fileObj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileObj.read(size)
+        self.digest.update(data)
+        return data
+
+
+# a tar archive that keeps a manifest of its entries while they are added: the name of every
+# entry without its top level directory and the sha256 of its contents. Packages put their
+# files in a directory named after the archive (which includes the build number), so the
+# manifest of the same files is the same for every build.
+class ManifestTarFile(tarfile.TarFile):
+    def __init__(self, *args, **kwargs):
+        tarfile.TarFile.__init__(self, *args, **kwargs)
+        self.manifest = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is not None:
+            fileobj = DigestReader(fileobj)
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        name = tarinfo.name.partition("/")[2]
+        if name:
+            contents = fileobj.digest.hexdigest() if fileobj is not None else "directory"
+            self.manifest.append("%s  %s\n" % (contents, name))
+
+    # the sha256 of the sorted manifest
+    def getManifestDigest(self):
+        return hashlib.sha256("".join(sorted(self.manifest)).encode("utf-8")).hexdigest()
+
+
+def getDigestPath(archivePath):
+    return archivePath + ".sha256"
+
+
+# returns the content digest that createArchive recorded for an archive (or None). The digest is
+# that of the manifest of the archive (see ManifestTarFile), so it depends only on the names and
+# contents of the files: not on the compressor, the time of the files or the build number.
+def readArchiveDigest(archivePath):
+    if not os.path.exists(getDigestPath(archivePath)):
+        return None
+    with open(getDigestPath(archivePath), "r") as digestFile:
+        return digestFile.read().split()[0]
+
+
+# opens the archive at archivePath for writing. The format is taken from the extension (see
+# ARCHIVE_FORMATS). The archive is compressed on numThreads threads by pigz or zstd where they
+# are installed, which runs at the same time as the files are read. The archive is only put at
+# archivePath once it is complete, together with its content digest (see readArchiveDigest).
+# Files that are links are stored as the files they point to. Add files with addToArchive.
+@contextlib.contextmanager
+def createArchive(archivePath, numThreads=1, deterministic=False):
+    archiveFormat = getArchiveFormat(archivePath)
+    compressorCommand = getCompressorCommand(archiveFormat, numThreads)
+    compressor = None
+    with atomicWrite(archivePath) as tmpArchivePath, open(tmpArchivePath, "wb") as archiveFile:
+        if compressorCommand is not None:
+            compressor = subprocess.Popen(compressorCommand, stdin=subprocess.PIPE, stdout=archiveFile)
+            outFile = compressor.stdin
+        elif archiveFormat == "tar.gz":
+            # no file name and a fixed time in the gzip header
+            outFile = gzip.GzipFile(filename="", mode="wb", fileobj=archiveFile, mtime=0)
+        else:
+            outFile = archiveFile
+        tarFormat = tarfile.GNU_FORMAT if deterministic else tarfile.DEFAULT_FORMAT
+        try:
+            with ManifestTarFile.open(fileobj=outFile, mode="w|", dereference=True, format=tarFormat) as tarFile:
+                yield tarFile
+        finally:
+            if compressor is not None:
+                compressor.stdin.close()
+                compressor.wait()
+            elif outFile is not archiveFile:
+                outFile.close()
+        if compressor is not None and compressor.returncode != 0:
+            failExecution("%s failed (%s) creating %s" % (compressorCommand[0], compressor.returncode, archivePath))
+        # the digest is written in the format of sha256sum
+        with atomicWrite(getDigestPath(archivePath)) as tmpDigestPath, open(tmpDigestPath, "w") as digestFile:
+            digestFile.write("%s  %s\n" % (tarFile.getManifestDigest(), os.path.basename(archivePath)))
+
+
+# makes an entry of a deterministic archive depend only on the contents of the file: the
+# owner is dropped, the time is fixed (SOURCE_DATE_EPOCH if set) and the permissions are
+# reduced to executable or not.
+def normalizeTarInfo(tarInfo):
+    tarInfo.mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+    tarInfo.uid = 0
+    tarInfo.gid = 0
+    tarInfo.uname = ""
+    tarInfo.gname = ""
+    tarInfo.mode = 0o755 if tarInfo.isdir() or tarInfo.mode & 0o111 else 0o644
+    return tarInfo
+
+
+# adds the file or directory tree at path to an archive opened with createArchive. For
+# deterministic archives the entries are added in sorted order and normalized, so that the
+# same files always make the same archive.
+def addToArchive(tarFile, path, arcname, deterministic=False):
+    if not deterministic:
+        tarFile.add(path, arcname=arcname)
+        return
+    tarFile.add(path, arcname=arcname, recursive=False, filter=normalizeTarInfo)
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            addToArchive(tarFile, os.path.join(path, name), arcname + "/" + name, deterministic)
+
+
+# opens an archive created by createArchive for reading. Archives that are decompressed by
+# another process can only be read in order (as a stream): iterate over the members instead
+# of looking them up by name.
+@contextlib.contextmanager
+def openArchive(archivePath):
+    compressorCommand = getCompressorCommand(getArchiveFormat(archivePath), 1, decompress=True)
+    if compressorCommand is None:
+        with tarfile.open(archivePath, "r:*") as tarFile:
+            yield tarFile
+        return
+    with open(archivePath, "rb") as archiveFile:
+        decompressor = subprocess.Popen(compressorCommand, stdin=archiveFile, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=decompressor.stdout, mode="r|") as tarFile:
+                yield tarFile
+        finally:
+            decompressor.stdout.close()
+            decompressor.wait()
 
 
 # this is no longer windows specific
@@ -248,3 +631,63 @@ def call(callable, args):
     # to construct "callableArgs" in the first place, to filter out excess arguments.
     callable(**callableArgs)
     return True
+
+
+def captureResult(function, args):
+    try:
+        return (True, function(*args))
+    except SystemExit as e:
+        # failExecution() has already printed where the failure happened
+        return (False, e)
+    except BaseException as e:
+        traceback.print_exc(file=sys.stdout)
+        return (False, e)
+
+
+class WorkerResult(object):
+    def __init__(self, asyncResult):
+        self._asyncResult = asyncResult
+
+    def ready(self):
+        return self._asyncResult.ready()
+
+    # waits for the function to finish and returns its result. If the function raised
+    # (or called failExecution()), the exception is raised again in this thread.
+    def get(self):
+        # a timeout keeps the waiting thread interruptible (KeyboardInterrupt)
+        while not self._asyncResult.ready():
+            self._asyncResult.wait(1)
+        succeeded, value = self._asyncResult.get()
+        if not succeeded:
+            raise value
+        return value
+
+
+# runs functions on a pool of threads. Unlike multiprocessing's ThreadPool, a worker that calls
+# failExecution() does not kill the worker thread (and hang the pool). The failure is handed
+# back to whoever asks for the result instead.
+class WorkerPool(object):
+    def __init__(self, numWorkers):
+        self._pool = multiprocessing.pool.ThreadPool(max(1, int(numWorkers)))
+
+    def submit(self, function, *args):
+        return WorkerResult(self._pool.apply_async(captureResult, (function, args)))
+
+    # calls function on every item and returns the results in order. The first failure
+    # is raised once every item has finished.
+    def map(self, function, items):
+        workerResults = [self.submit(function, item) for item in items]
+        results = []
+        failure = None
+        for workerResult in workerResults:
+            try:
+                results.append(workerResult.get())
+            except (Exception, SystemExit) as e:
+                failure = e if failure is None else failure
+        if failure is not None:
+            raise failure
+        return results
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
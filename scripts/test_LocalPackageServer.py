@@ -0,0 +1,109 @@
+# SYSTEM IMPORTS
+import os
+import shutil
+import tempfile
+import unittest
+
+# PYTHON PROJECT IMPORTS
+import HTTPRequest
+import LocalPackageServer
+import MetadataCache
+import PackageStoreRequest
+
+
+# runs the requests that a build makes (upload, query, resolveLatest and resumed downloads)
+# against a LocalPackageServer on an ephemeral port, and the same requests against a
+# PackageStoreRequest (-offline builds).
+class LocalPackageServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix="rbuild_test_")
+        self.server = LocalPackageServer.start(os.path.join(self.tmpDir, "server"))
+        self.httpRequest = HTTPRequest.HTTPRequest(self.server.getUrl())
+        self.fileContents = os.urandom(256 * 1024)
+        for buildNum in [1, 2]:
+            self.uploadPackage(self.httpRequest, buildNum)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def uploadPackage(self, request, buildNum):
+        fileName = "pkg_%s" % buildNum
+        uploadDir = os.path.join(self.tmpDir, "upload")
+        if not os.path.exists(uploadDir):
+            os.makedirs(uploadDir)
+        with open(os.path.join(uploadDir, fileName + ".tar.gz"), "wb") as f:
+            f.write(self.fileContents)
+        request.upload(uploadDir, "packages", "pkg", fileName=fileName + ".tar.gz",
+                       dbParams={"build_num": buildNum, "config": "release", "fileName": fileName,
+                                 "filetype": ".tar.gz", "relativeUrl": "pkg/release/%s.tar.gz" % fileName},
+                       urlParams=["pkg", "release"])
+
+    def testQueryReturnsUploadedRecords(self):
+        records = self.httpRequest.query("packages", "pkg", dbParams={"config": "release"}, keysToKeep=["build_num"])
+        # uploaded records are sent as form fields, so the server stores their values as strings
+        self.assertEqual(sorted([str(record["build_num"]) for record in records]), ["1", "2"])
+        self.assertEqual(self.httpRequest.query("packages", "pkg", dbParams={"config": "debug"}), [])
+
+    def testEmptyQueryIsNotCached(self):
+        self.httpRequest.metadataCache = MetadataCache.MetadataCache(os.path.join(self.tmpDir, "metadata"), 3600)
+        query = ["packages", "pkg", {"build_num": "3"}, ["build_num"]]
+        self.assertEqual(self.httpRequest.query(*query), [])
+        self.uploadPackage(self.httpRequest, 3)
+        records = self.httpRequest.query(*query)
+        self.assertEqual([str(record["build_num"]) for record in records], ["3"])
+
+    def testResolveLatest(self):
+        latest, missing = self.httpRequest.resolveLatest("packages", [["pkg", {"config": "release"}],
+                                                                      ["missing", {"config": "release"}]])
+        self.assertEqual(str(latest["build_num"]), "2")
+        self.assertIsNone(missing)
+
+    # leaves the first 1000 bytes of an interrupted download of pkg_2 that was started when the
+    # file had the ETag validator. The bytes differ from the file on the server, so the result
+    # shows whether only the rest of the file was downloaded.
+    def interruptDownload(self, validator):
+        downloadDir = os.path.join(self.tmpDir, "download")
+        os.makedirs(downloadDir)
+        filePath = os.path.join(downloadDir, "pkg_2.tar.gz")
+        with open(filePath + ".part", "wb") as f:
+            f.write(b"x" * 1000)
+        with open(filePath + ".part.validator", "w") as f:
+            f.write(validator + "\n")
+        return filePath
+
+    def downloadLatest(self, filePath):
+        record = self.httpRequest.resolveLatest("packages", [["pkg", {"config": "release"}]])[0]
+        self.httpRequest.downloadRecord(os.path.dirname(filePath), record)
+        self.assertFalse(os.path.exists(filePath + ".part"))
+        self.assertFalse(os.path.exists(filePath + ".part.validator"))
+        with open(filePath, "rb") as f:
+            return f.read()
+
+    def testResumeDownload(self):
+        response = self.httpRequest.session.get(HTTPRequest.urljoin(self.server.getUrl(), "pkg/release/pkg_2.tar.gz"))
+        filePath = self.interruptDownload(response.headers["ETag"])
+        self.assertEqual(self.downloadLatest(filePath), b"x" * 1000 + self.fileContents[1000:])
+
+    def testRestartDownloadOfChangedFile(self):
+        filePath = self.interruptDownload('"replaced"')
+        self.assertEqual(self.downloadLatest(filePath), self.fileContents)
+
+    def testPackageStoreRequest(self):
+        storeRequest = PackageStoreRequest.PackageStoreRequest(os.path.join(self.tmpDir, "store"))
+        for buildNum in [1, 2]:
+            self.uploadPackage(storeRequest, buildNum)
+        latest, missing = storeRequest.resolveLatest("packages", [["pkg", {"config": "release"}],
+                                                                  ["missing", {"config": "release"}]])
+        self.assertEqual(latest["build_num"], 2)
+        self.assertIsNone(missing)
+        downloadDir = os.path.join(self.tmpDir, "download")
+        os.makedirs(downloadDir)
+        storeRequest.downloadRecord(downloadDir, latest)
+        with open(os.path.join(downloadDir, "pkg_2.tar.gz"), "rb") as f:
+            self.assertEqual(f.read(), self.fileContents)
+
+
+if __name__ == "__main__":
+    unittest.main()